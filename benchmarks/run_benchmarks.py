@@ -0,0 +1,391 @@
+"""
+Micro-benchmarks for the per-request overhead of the exporter
+and for the cost of generating the metrics output on a scrape.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --requests 20000 --filter defaults
+    python benchmarks/run_benchmarks.py --filter threads
+
+The `threads` benchmarks spread the requests over a number of threads and
+report the wall-clock time per request, which should go down with more threads
+on free-threaded Python builds running without the GIL.
+
+Each request benchmark calls the WSGI application of a Flask app directly,
+without an HTTP server or the Flask test client, and reports the time spent
+per request, and the peak memory traced while handling a request.
+Compare the numbers against the `bare flask` case to get the overhead
+of the exporter itself.
+"""
+
+import argparse
+import gc
+import itertools
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, request  # noqa: E402
+from prometheus_client import CollectorRegistry, Counter, generate_latest, values  # noqa: E402
+from prometheus_client.mmap_dict import MmapedDict, mmap_key  # noqa: E402
+from prometheus_client.multiprocess import MultiProcessCollector  # noqa: E402
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+from prometheus_flask_exporter import PrometheusMetrics, _EXCLUDED_PATHS_CACHE_SIZE  # noqa: E402
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics  # noqa: E402
+from prometheus_flask_exporter.multiprocess import IncrementalMultiProcessCollector  # noqa: E402
+from prometheus_flask_exporter.multiprocess import SharedMemoryCollector  # noqa: E402
+from prometheus_flask_exporter.multiprocess import _SharedMemorySegment, _SharedMemorySlot  # noqa: E402
+
+
+# the temporary directories of the benchmark being measured, removed after it
+_temporary_directories = []
+
+
+def _start_response(status, headers, exc_info=None):
+    return lambda data: None
+
+
+def _temporary_directory():
+    directory = tempfile.TemporaryDirectory(prefix='prometheus-flask-exporter-benchmark-')
+    _temporary_directories.append(directory)
+    return directory.name
+
+
+def _remove_temporary_directories():
+    while _temporary_directories:
+        _temporary_directories.pop().cleanup()
+
+
+def _create_app():
+    app = Flask('benchmark')
+
+    @app.route('/ping')
+    def ping():
+        return 'pong'
+
+    return app
+
+
+def _request_runner(app, *paths):
+    # cycles through the given paths, or requests /ping only
+    environs = itertools.cycle([EnvironBuilder(path=path).get_environ() for path in paths or ('/ping',)])
+
+    def run():
+        app_iter = app(dict(next(environs)), _start_response)
+        for _ in app_iter:
+            pass
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    return run
+
+
+def _measure(run, iterations):
+    # warm up caches, lazily created children, etc.
+    for _ in range(min(iterations, 200)):
+        run()
+
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter_ns()
+        for _ in range(iterations):
+            run()
+        elapsed = time.perf_counter_ns() - started
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return elapsed / iterations, peak
+
+
+def _measure_threads(run, iterations, threads):
+    for _ in range(min(iterations, 200)):
+        run()
+
+    per_thread = iterations // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        barrier.wait()
+        for _ in range(per_thread):
+            run()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    barrier.wait()
+    started = time.perf_counter_ns()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter_ns() - started
+
+    return elapsed / (per_thread * threads)
+
+
+def bench_bare_flask():
+    return _request_runner(_create_app())
+
+
+def bench_defaults(**kwargs):
+    def setup():
+        app = _create_app()
+        PrometheusMetrics(app, registry=CollectorRegistry(), **kwargs)
+        return _request_runner(app)
+
+    return setup
+
+
+def bench_multiprocess_defaults(batched_writes=False):
+    def setup():
+        # changes the value class of the metrics created later, so these run last
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = _temporary_directory()
+
+        if batched_writes:
+            GunicornInternalPrometheusMetrics.use_batched_writes()
+        else:
+            values.ValueClass = values.MultiProcessValue()
+
+        app = _create_app()
+        metrics = GunicornInternalPrometheusMetrics(app)
+        app.view_functions['ping'] = metrics.counter('bench_pings', 'Pings')(app.view_functions['ping'])
+        return _request_runner(app)
+
+    return setup
+
+
+def bench_decorator(metric_type, label_kind, **kwargs):
+    labels = {
+        'none': None,
+        'static': {'region': 'eu-west-1', 'version': '1.0'},
+        'no-args': {'path': lambda: request.path},
+        'response': {'status': lambda r: r.status_code},
+    }[label_kind]
+
+    def setup():
+        app = Flask('benchmark')
+        metrics = PrometheusMetrics(app, registry=CollectorRegistry(), export_defaults=False, **kwargs)
+
+        @app.route('/ping')
+        @getattr(metrics, metric_type)('bench_%s' % metric_type, 'Benchmark metric', labels=labels)
+        def ping():
+            return 'pong'
+
+        return _request_runner(app)
+
+    return setup
+
+
+def bench_excluded_paths(count, distinct_paths=True):
+    def setup():
+        app = _create_app()
+
+        @app.route('/<path:path>')
+        def any_path(path):
+            return 'ok'
+
+        PrometheusMetrics(
+            app, registry=CollectorRegistry(), group_by='url_rule',
+            excluded_paths=['/excluded/%d/.*' % idx for idx in range(count)]
+        )
+
+        if not distinct_paths:
+            return _request_runner(app)
+
+        # more distinct paths than the excluded paths cache holds, so each one
+        # is matched against the patterns, half of them excluded, half of them not
+        return _request_runner(app, *[
+            '/excluded/%d/item/%d' % (idx % count, idx) if idx % 2 else '/included/item/%d' % idx
+            for idx in range(4 * _EXCLUDED_PATHS_CACHE_SIZE)
+        ])
+
+    return setup
+
+
+def bench_generate_metrics(series):
+    def setup():
+        registry = CollectorRegistry()
+        metrics = PrometheusMetrics(None, registry=registry, export_defaults=False)
+
+        counter = Counter('bench_series', 'Benchmark series', ('a', 'b'), registry=registry)
+        for idx in range(series):
+            counter.labels(str(idx % 100), str(idx // 100)).inc(idx)
+
+        return lambda: metrics.generate_metrics()
+
+    return setup
+
+
+def bench_metrics_endpoint(series, **kwargs):
+    def setup():
+        app = Flask('benchmark')
+        registry = CollectorRegistry()
+        PrometheusMetrics(app, registry=registry, export_defaults=False, **kwargs)
+
+        # spread the series over 100 metric families
+        for family in range(100):
+            counter = Counter('bench_series_%d' % family, 'Benchmark series', ('a',), registry=registry)
+            for idx in range(series // 100):
+                counter.labels(str(idx)).inc(idx)
+
+        return _request_runner(app, '/metrics')
+
+    return setup
+
+
+def _multiprocess_keys():
+    # a counter and a histogram with 10 endpoints in each process
+    return (
+        ('counter', [mmap_key('bench_requests', 'bench_requests_total', ['endpoint'], [str(ep)],
+                              'Benchmark requests') for ep in range(10)]),
+        ('histogram', [mmap_key('bench_latency', 'bench_latency_bucket', ['endpoint', 'le'], [str(ep), le],
+                                'Benchmark latency')
+                       for ep in range(10) for le in ('0.1', '0.5', '1.0', '+Inf')]),
+    )
+
+
+def bench_multiprocess_collect(processes, collector_type, **kwargs):
+    def setup():
+        directory = _temporary_directory()
+
+        for pid in range(processes):
+            for typ, keys in _multiprocess_keys():
+                values = MmapedDict(os.path.join(directory, '%s_%d.db' % (typ, pid)))
+                for key in keys:
+                    values.write_value(key, pid, 0)
+                values.close()
+
+        registry = CollectorRegistry()
+        collector_type(registry, path=directory, **kwargs)
+
+        return lambda: generate_latest(registry)
+
+    return setup
+
+
+def bench_shared_memory_collect(processes):
+    def setup():
+        segment = _SharedMemorySegment(processes, 64 * 1024)
+
+        for slot in range(processes):
+            region = _SharedMemorySlot(segment, slot)
+            for typ, keys in _multiprocess_keys():
+                for key in keys:
+                    pos = region.position('%s:%s' % (typ, key))
+                    region.data[pos:pos + 16] = struct.pack('dd', slot, 0)
+
+        registry = CollectorRegistry()
+        SharedMemoryCollector(registry, segment)
+
+        return lambda: generate_latest(registry)
+
+    return setup
+
+
+def _benchmarks():
+    yield 'bare flask', bench_bare_flask
+    yield 'defaults', bench_defaults()
+    yield 'defaults (summary)', bench_defaults(default_latency_as_histogram=False)
+    yield 'defaults (cached children)', bench_defaults(default_cache_children=True)
+    yield 'defaults (wsgi mode)', bench_defaults(mode='wsgi')
+    yield 'defaults (sharded metrics)', bench_defaults(sharded_metrics=True)
+    yield 'defaults (default labels)', bench_defaults(default_labels={
+        'static': 'value', 'method_label': lambda: request.method
+    })
+
+    for metric_type in ('counter', 'gauge', 'histogram', 'summary'):
+        for label_kind in ('none', 'static', 'no-args', 'response'):
+            if metric_type == 'gauge' and label_kind == 'response':
+                continue  # gauges are updated before the response is available
+
+            yield '%s (%s labels)' % (metric_type, label_kind), bench_decorator(metric_type, label_kind)
+
+    for count in (1, 10, 100):
+        yield 'excluded_paths x%d' % count, bench_excluded_paths(count)
+        yield 'excluded_paths x%d (cached /ping)' % count, bench_excluded_paths(count, distinct_paths=False)
+
+    for series in (1000, 10000, 100000):
+        yield 'generate_metrics %d series' % series, bench_generate_metrics(series)
+
+    for series in (10000, 100000):
+        yield 'generate_metrics endpoint %d series' % series, bench_metrics_endpoint(series)
+        yield 'generate_metrics streamed %d series' % series, bench_metrics_endpoint(series, stream_metrics=True)
+        yield 'generate_metrics cached families %d series' % series, bench_metrics_endpoint(
+            series, cache_rendered_families=True
+        )
+
+    for processes in (32, 320):
+        yield 'generate_metrics multiprocess %d files' % (processes * 2), \
+            bench_multiprocess_collect(processes, MultiProcessCollector)
+        yield 'generate_metrics incremental multiprocess %d files' % (processes * 2), \
+            bench_multiprocess_collect(processes, IncrementalMultiProcessCollector)
+        yield 'generate_metrics parallel multiprocess %d files' % (processes * 2), \
+            bench_multiprocess_collect(processes, IncrementalMultiProcessCollector, read_workers=4)
+        yield 'generate_metrics shared memory %d slots' % processes, bench_shared_memory_collect(processes)
+
+    for threads in (1, 4, 8):
+        yield 'threads x%d bare flask' % threads, bench_bare_flask
+        yield 'threads x%d defaults' % threads, bench_defaults(sharded_metrics=False)
+        yield 'threads x%d defaults (sharded metrics)' % threads, bench_defaults(sharded_metrics=True)
+        yield 'threads x%d histogram (no-args labels)' % threads, \
+            bench_decorator('histogram', 'no-args', sharded_metrics=False)
+        yield 'threads x%d histogram (no-args labels, sharded metrics)' % threads, \
+            bench_decorator('histogram', 'no-args', sharded_metrics=True)
+
+    yield 'defaults (multiprocess)', bench_multiprocess_defaults()
+    yield 'defaults (multiprocess, batched writes)', bench_multiprocess_defaults(batched_writes=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='the number of requests to measure for each benchmark')
+    parser.add_argument('--scrapes', type=int, default=5,
+                        help='the number of metrics generations to measure for each benchmark')
+    parser.add_argument('--filter', default=None,
+                        help='a regular expression to select the benchmarks to run by name')
+    args = parser.parse_args()
+
+    gil_enabled = sys._is_gil_enabled() if hasattr(sys, '_is_gil_enabled') else True
+    print('# Python %s, GIL %s' % (sys.version.split()[0], 'enabled' if gil_enabled else 'disabled'))
+    print('%-56s %14s %12s' % ('benchmark', 'ns/op', 'peak bytes'))
+
+    for name, setup in _benchmarks():
+        if args.filter and not re.search(args.filter, name):
+            continue
+
+        threads = re.match(r'threads x(\d+) ', name)
+        if threads:
+            # the wall-clock time per request, without the memory measurements
+            per_op = _measure_threads(setup(), args.requests, int(threads.group(1)))
+            print('%-56s %14.0f %12s' % (name, per_op, '-'))
+            continue
+
+        iterations = args.scrapes if name.startswith('generate_metrics') else args.requests
+        try:
+            per_op, peak = _measure(setup(), iterations)
+        finally:
+            _remove_temporary_directories()
+
+        print('%-56s %14.0f %12d' % (name, per_op, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,16 @@ import re
 import sys
 import threading
 import warnings
+import zlib
 from timeit import default_timer
 
 from flask import Flask, Response
-from flask import request, make_response, current_app
+from flask import request, make_response, current_app, has_request_context
+from flask.signals import got_request_exception
 from flask.views import MethodView
 from prometheus_client import Counter, Histogram, Gauge, Summary
-from prometheus_client import multiprocess as pc_multiprocess, CollectorRegistry
+from prometheus_client import CollectorRegistry
+from prometheus_client import values
 try:
     # prometheus-client >= 0.14.0
     from prometheus_client.exposition import choose_encoder
@@ -20,6 +23,7 @@ except ImportError:
     from prometheus_client.exposition import choose_formatter as choose_encoder
 
 from werkzeug.serving import is_running_from_reloader
+from werkzeug.wsgi import ClosingIterator
 
 if sys.version_info[0:2] >= (3, 4):
     # Python v3.4+ has a built-in has __wrapped__ attribute
@@ -49,6 +53,12 @@ except ImportError:
     def _to_status_code(response_status):
         return response_status
 
+try:
+    # optional support for zstd compressed metrics responses
+    import zstandard
+except ImportError:
+    zstandard = None
+
 NO_PREFIX = '#no_prefix'
 """
 Constant indicating that default metrics should not have any prefix applied.
@@ -57,6 +67,450 @@ documentation (see: https://prometheus.io/docs/concepts/data_model/#metric-names
 """
 
 
+_EXCLUDED_PATHS_CACHE_SIZE = 1024
+
+_RESTRICTED_REGISTRIES_CACHE_SIZE = 64
+
+_TRACKING_KEY = 'prometheus_flask_exporter.tracking'
+
+
+class _RequestTracking:
+    """
+    The tracking state of a single request, like its start time,
+    the flags set by the decorators and the label values resolved for it.
+
+    The `label_snapshot` shares the values of no-argument label callables
+    between the metrics of the request, and it is only used once the
+    request handler has returned.
+    """
+
+    __slots__ = (
+        'start_time', 'do_not_track', 'exclude_all',
+        'duration_reported', 'total_reported', 'exception',
+        'label_snapshot', 'wsgi_labels', 'connexion_content_type',
+    )
+
+    def __init__(self):
+        self.start_time = None
+        self.do_not_track = False
+        self.exclude_all = False
+        self.duration_reported = False
+        self.total_reported = False
+        self.exception = False
+        self.label_snapshot = {}
+        self.wsgi_labels = None
+        self.connexion_content_type = None
+
+
+def _request_tracking():
+    """
+    Returns the tracking state of the current request,
+    attaching a new one to its WSGI environment on first use.
+    """
+
+    environ = request.environ
+
+    try:
+        return environ[_TRACKING_KEY]
+    except KeyError:
+        tracking = environ[_TRACKING_KEY] = _RequestTracking()
+        return tracking
+
+
+class _MetricsCache:
+    """
+    Keeps generated metrics output for a limited time.
+    Concurrent requests for output that is not cached (or has expired)
+    wait for a single generation instead of generating it on their own.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}
+        self._generation_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, generate, variant=None, derive=None):
+        """
+        Returns the cached value for the key,
+        or generates and caches it when it's missing or expired.
+
+        :param key: the (hashable) key of the value
+        :param generate: a function without arguments to generate the value
+        :param variant: the (hashable) key of a variant of the value to return
+            instead, like its compressed form, that is cached with the value,
+            and expires together with it
+        :param derive: a function to create the variant from the value
+        :return: the cached or newly generated value (or its variant)
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > default_timer():
+            return self._variant(entry, variant, derive)
+
+        with self._lock:
+            generation_lock = self._generation_locks.setdefault(key, threading.Lock())
+
+        with generation_lock:
+            # another request may have generated it while waiting for the lock
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > default_timer():
+                return self._variant(entry, variant, derive)
+
+            value = generate()
+
+            with self._lock:
+                now = default_timer()
+
+                # drop expired entries, so different keys (like `name[]` filters)
+                # don't keep accumulating in the cache
+                for expired_key in [k for k, entry in self._entries.items() if entry[0] <= now]:
+                    del self._entries[expired_key]
+                    if expired_key != key:
+                        self._generation_locks.pop(expired_key, None)
+
+                entry = self._entries[key] = (now + self._ttl, value, {})
+
+            return self._variant(entry, variant, derive)
+
+    @staticmethod
+    def _variant(entry, variant, derive):
+        if variant is None:
+            return entry[1]
+
+        variants = entry[2]
+        try:
+            return variants[variant]
+        except KeyError:
+            # concurrent requests may derive it more than once, with the same result
+            derived = variants[variant] = derive(entry[1])
+            return derived
+
+
+# supported compressions of the metrics output, in the order of preference
+_CONTENT_ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+
+def _compressor(content_encoding, level=None):
+    """
+    Create a compressor object for the metrics output,
+    that has `compress(data)` and `flush()` methods.
+
+    :param content_encoding: the compression to use, `gzip` or `zstd`
+    :param level: the compression level, or `None` for the default
+    :return: a new compressor object
+    """
+
+    if content_encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    else:
+        # wbits=31 produces a gzip header and trailer
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+
+
+def _compress_output(data, content_encoding, level=None):
+    """
+    Compress the metrics output.
+
+    :param data: the output to compress (as `bytes`)
+    :param content_encoding: the compression to use, `gzip` or `zstd`
+    :param level: the compression level, or `None` for the default
+    :return: the compressed output
+    """
+
+    compressor = _compressor(content_encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _MetricFamilies:
+    """
+    A collector returning a fixed list of metric families,
+    used to render metric families one by one.
+    """
+
+    def __init__(self, families):
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
+def _render_family(generate_latest, family, trailer):
+    """
+    Render a single metric family without the trailer of the output format.
+    """
+
+    output = generate_latest(_MetricFamilies([family]))
+    if trailer:
+        return output[:-len(trailer)]
+    return output
+
+
+class _RenderedFamilies:
+    """
+    Keeps the rendered output of each metric family from the previous
+    metrics output, for each output format, and reuses it for the families
+    that have the same samples (and metadata) on the next one.
+
+    Comparing the collected samples is much cheaper than formatting them,
+    so the cost of generating the output depends on the number of
+    changed families, rather than on the number of all of them.
+    """
+
+    def __init__(self):
+        self._rendered = {}
+
+    def render(self, generate_latest, content_type, families, trailer):
+        """
+        Render the metric families, reusing the previous output where possible.
+
+        :param generate_latest: the function to render the output format
+        :param content_type: the content type of the output format
+        :param families: the collected metric families
+        :param trailer: the trailer of the output format
+        :return: a generator of the rendered families (as `bytes`)
+        """
+
+        previous = self._rendered.get(content_type, {})
+        current = {}
+
+        for family in families:
+            state = (family.documentation, family.type, family.unit, family.samples)
+
+            cached = previous.get(family.name)
+            if cached is not None and cached[0] == state:
+                output = cached[1]
+            else:
+                output = _render_family(generate_latest, family, trailer)
+
+            current[family.name] = (state, output)
+            yield output
+
+        # replacing the whole mapping drops the families that are gone
+        self._rendered[content_type] = current
+
+
+_LABEL_STATIC = 0
+_LABEL_NO_ARGS = 1
+_LABEL_RESPONSE = 2
+
+
+def _argspec(func):
+    if hasattr(inspect, 'getfullargspec'):
+        return inspect.getfullargspec(func)
+    else:
+        return inspect.getargspec(func)
+
+
+class _ShardedValue:
+    """
+    A float split into a shard for each thread changing it, so that
+    the threads don't contend on a lock, summed up when it's read.
+
+    Only the thread owning a shard changes it, the shards of the threads
+    that have exited are folded into the base value when it's read.
+    Setting the value is not atomic with concurrent increments.
+
+    The shards of a thread are kept in a `threading.local`, shared by
+    the values of a metric child and keyed by the value.
+    """
+
+    _multiprocess = False
+
+    def __init__(self, local):
+        self._base = 0.0
+        self._shards = []
+        self._local = local
+        self._exemplar = None
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        try:
+            shards = self._local.shards
+        except AttributeError:
+            shards = self._local.shards = {}
+
+        shard = shards[self] = [0.0]
+
+        with self._lock:
+            self._shards.append((threading.current_thread(), shard))
+
+        return shard
+
+    def inc(self, amount):
+        try:
+            shard = self._local.shards[self]
+        except (AttributeError, KeyError):
+            shard = self._new_shard()
+
+        shard[0] += amount
+
+    def set(self, value, timestamp=None):
+        with self._lock:
+            for _, shard in self._shards:
+                shard[0] = 0.0
+
+            self._base = value
+
+    def set_exemplar(self, exemplar):
+        with self._lock:
+            self._exemplar = exemplar
+
+    def get(self):
+        with self._lock:
+            shards = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    shards.append((thread, shard))
+                else:
+                    self._base += shard[0]
+
+            self._shards = shards
+
+            return self._base + sum(shard[0] for _, shard in shards)
+
+    def get_exemplar(self):
+        with self._lock:
+            return self._exemplar
+
+
+class _ShardedMetric:
+    """
+    Looks up the existing labeled children of a metric without taking
+    the lock of the parent, which is only needed to create new ones.
+    """
+
+    def labels(self, *labelvalues, **labelkwargs):
+        children = getattr(self, '_metrics', None)
+
+        if children is not None and not self._labelvalues:
+            if labelvalues and not labelkwargs and len(labelvalues) == len(self._labelnames):
+                child = children.get(tuple(str(value) for value in labelvalues))
+            elif labelkwargs and not labelvalues and len(labelkwargs) == len(self._labelnames):
+                try:
+                    child = children.get(tuple(str(labelkwargs[name]) for name in self._labelnames))
+                except KeyError:
+                    child = None  # incorrect label names
+            else:
+                child = None
+
+            if child is not None:
+                return child
+
+        # validates the label values, and creates the child when it's missing
+        return super().labels(*labelvalues, **labelkwargs)
+
+
+class _ShardedCounter(_ShardedMetric, Counter):
+    """
+    A `Counter` with a value sharded by threads.
+    """
+
+    def _metric_init(self):
+        super()._metric_init()
+        self._value = _ShardedValue(threading.local())
+
+
+class _ShardedHistogram(_ShardedMetric, Histogram):
+    """
+    A `Histogram` with its sum and buckets sharded by threads.
+    """
+
+    def _metric_init(self):
+        super()._metric_init()
+        local = threading.local()
+        self._sum = _ShardedValue(local)
+        self._buckets = [_ShardedValue(local) for _ in self._buckets]
+
+
+class _ShardedSummary(_ShardedMetric, Summary):
+    """
+    A `Summary` with its count and sum sharded by threads.
+    """
+
+    def _metric_init(self):
+        super()._metric_init()
+        local = threading.local()
+        self._count = _ShardedValue(local)
+        self._sum = _ShardedValue(local)
+
+
+_SHARDED_METRIC_TYPES = {
+    Counter: _ShardedCounter,
+    Histogram: _ShardedHistogram,
+    Summary: _ShardedSummary,
+}
+
+
+class _CombinedLabels:
+    """
+    Label names and values of a metric, combined from the labels
+    given for it and the default labels of the `PrometheusMetrics` instance.
+
+    Callable label values are inspected once here, when the metric is
+    set up, so resolving the values for a request only needs to invoke them.
+    """
+
+    def __init__(self, labels):
+        self.labels = tuple(labels.items())
+        self._resolvers = tuple(
+            (key, _CombinedLabels._resolver_kind(value), value)
+            for key, value in self.labels
+        )
+
+    @staticmethod
+    def _resolver_kind(value):
+        if not callable(value):
+            return _LABEL_STATIC
+        if _argspec(value).args:
+            return _LABEL_RESPONSE
+        else:
+            return _LABEL_NO_ARGS
+
+    def keys(self):
+        return tuple(key for key, _ in self.labels)
+
+    def has_keys(self):
+        return len(self.labels) > 0
+
+    def has_response_values(self):
+        return any(kind == _LABEL_RESPONSE for _, kind, _ in self._resolvers)
+
+    def has_only_static_values(self):
+        return all(kind == _LABEL_STATIC for _, kind, _ in self._resolvers)
+
+    def get_default_values(self):
+        return list(value for key, value in self.labels)
+
+    def values_for(self, response, snapshot=None):
+        """
+        Resolve the label values for the current request.
+
+        :param response: the response to pass to single argument callables
+        :param snapshot: an optional dictionary of the values already
+            resolved on the current request, no-argument callables are
+            only invoked when they are not in there yet
+        :return: a dictionary of label names and values
+        """
+
+        values = {}
+
+        for key, kind, value in self._resolvers:
+            if kind == _LABEL_STATIC:
+                values[key] = value
+            elif kind == _LABEL_RESPONSE:
+                values[key] = value(response)
+            elif snapshot is None:
+                values[key] = value()
+            else:
+                try:
+                    values[key] = snapshot[id(value)]
+                except KeyError:
+                    values[key] = snapshot[id(value)] = value()
+
+        return values
+
+
 class PrometheusMetrics:
     """
     Prometheus metrics export configuration for Flask.
@@ -116,11 +570,21 @@ class PrometheusMetrics:
                  group_by='path',
                  buckets=None,
                  default_latency_as_histogram=True,
+                 default_cache_children=False,
                  default_labels=None,
+                 mode='flask',
                  response_converter=None,
                  excluded_paths=None,
+                 excluded_endpoints=None,
+                 excluded_rules=None,
                  exclude_user_defaults=True,
                  metrics_decorator=None,
+                 metrics_cache_ttl=None,
+                 compress_metrics=False,
+                 compress_level=None,
+                 stream_metrics=False,
+                 cache_rendered_families=False,
+                 sharded_metrics=False,
                  registry=None, **kwargs):
         """
         Create a new Prometheus metrics export configuration.
@@ -140,16 +604,52 @@ class PrometheusMetrics:
             (will use the default when `None`)
         :param default_latency_as_histogram: export request latencies
             as a Histogram (defaults), otherwise use a Summary
+        :param default_cache_children: keep the labeled children of the
+            default metrics in a cache to skip looking them up by label
+            values on each request (defaults to `False`)
         :param default_labels: default labels to attach to each of the
             metrics exposed by this `PrometheusMetrics` instance
+        :param mode: how to measure the default metrics, either `flask`
+            to use Flask request callbacks (the default), or `wsgi` to wrap
+            the WSGI application of the Flask app, so that the whole request
+            is measured, including other request callbacks and the streaming
+            of the response body
         :param response_converter: a function that converts the captured
             the produced response object to a Flask friendly representation
         :param metrics_decorator: an optional decorator to apply to the
             metrics endpoint, takes a function and needs to return a function
+        :param metrics_cache_ttl: the number of seconds to reuse the generated
+            metrics output for, concurrent requests for the same output
+            also wait for a single generation to finish
+            (defaults to `None` to generate it on every request)
+        :param compress_metrics: compress the response of the metrics endpoint
+            when the client accepts it, using `gzip`, or `zstd` when
+            the `zstandard` package is installed (defaults to `False`)
+        :param compress_level: the compression level to use, or `None`
+            for the default level of the chosen compression
+        :param stream_metrics: stream the response of the metrics endpoint
+            one metric family at a time, instead of generating
+            the whole output in memory first (defaults to `False`,
+            and has no effect when `metrics_cache_ttl` is set)
+        :param cache_rendered_families: keep the rendered output of each
+            metric family, and reuse it on the next scrape when the family
+            did not change, for outputs without `name[]` filters
+            (defaults to `False`)
+        :param sharded_metrics: keep the values of the counters, histograms
+            and summaries of the default metrics and the decorators in a shard
+            for each thread updating them, summed up on scrapes, so that
+            request threads don't contend on their locks, like on
+            free-threaded Python builds running without the GIL
+            (defaults to `False`, and has no effect in multiprocess mode)
         :param excluded_paths: regular expression(s) as a string or
             a list of strings for paths to exclude from tracking
-        :param exclude_user_defaults: also apply the `excluded_paths`
-            exclusions to user-defined defaults (not only built-in ones)
+        :param excluded_endpoints: endpoint name(s) as a string or
+            a list of strings for endpoints to exclude from tracking
+        :param excluded_rules: URL rule(s) as a string or a list of strings,
+            like `/items/<int:item_id>`, for routes to exclude from tracking
+        :param exclude_user_defaults: also apply the `excluded_paths`,
+            `excluded_endpoints` and `excluded_rules` exclusions
+            to user-defined defaults (not only built-in ones)
         :param registry: the Prometheus Registry to use
         """
 
@@ -159,8 +659,21 @@ class PrometheusMetrics:
         self._defaults_prefix = defaults_prefix or 'flask'
         self._default_labels = default_labels or {}
         self._default_latency_as_histogram = default_latency_as_histogram
+        self._default_cache_children = default_cache_children
+        self._mode = mode
         self._response_converter = response_converter or make_response
         self._metrics_decorator = metrics_decorator
+        self._metrics_cache = _MetricsCache(metrics_cache_ttl) if metrics_cache_ttl else None
+        self._compress_metrics = compress_metrics
+        self._compress_level = compress_level
+        self._stream_metrics = stream_metrics
+        self._rendered_families = _RenderedFamilies() if cache_rendered_families else None
+        self._sharded_metrics = sharded_metrics
+        self._multiprocess = 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ
+        self._multiprocess_registry = None
+        self._multiprocess_options = {}
+        self._restricted_registries = {}
+        self._registry_lock = threading.Lock()
         self.buckets = buckets
         self.version = __version__
 
@@ -199,6 +712,9 @@ class PrometheusMetrics:
         else:
             self.group_by = 'path'
 
+        if mode not in ('flask', 'wsgi'):
+            raise ValueError('The mode needs to be either `flask` or `wsgi`, got: %s' % mode)
+
         if excluded_paths:
             if PrometheusMetrics._is_string(excluded_paths):
                 excluded_paths = [excluded_paths]
@@ -209,6 +725,24 @@ class PrometheusMetrics:
         else:
             self.excluded_paths = None
 
+        self._is_excluded_path = self._create_excluded_path_matcher(self.excluded_paths)
+
+        if excluded_endpoints:
+            if PrometheusMetrics._is_string(excluded_endpoints):
+                excluded_endpoints = [excluded_endpoints]
+
+            self.excluded_endpoints = frozenset(excluded_endpoints)
+        else:
+            self.excluded_endpoints = None
+
+        if excluded_rules:
+            if PrometheusMetrics._is_string(excluded_rules):
+                excluded_rules = [excluded_rules]
+
+            self.excluded_rules = frozenset(excluded_rules)
+        else:
+            self.excluded_rules = None
+
         self.exclude_user_defaults = exclude_user_defaults
 
         if app is not None:
@@ -251,6 +785,8 @@ class PrometheusMetrics:
             self.export_defaults(
                 buckets=self.buckets, group_by=self.group_by,
                 latency_as_histogram=self._default_latency_as_histogram,
+                cache_children=self._default_cache_children,
+                mode=self._mode,
                 prefix=self._defaults_prefix, app=app
             )
 
@@ -282,8 +818,22 @@ class PrometheusMetrics:
             else:
                 names = None
 
-            generated_data, content_type = self.generate_metrics(accept_header, names)
+            if self._compress_metrics:
+                content_encoding = request.accept_encodings.best_match(_CONTENT_ENCODINGS)
+            else:
+                content_encoding = None
+
+            generated_data, content_type = self._generate_metrics_output(
+                accept_header, names, content_encoding, stream=self._stream_metrics
+            )
             headers = {'Content-Type': content_type}
+            if self._compress_metrics:
+                headers['Vary'] = 'Accept-Encoding'
+            if content_encoding:
+                headers['Content-Encoding'] = content_encoding
+            if not isinstance(generated_data, bytes):
+                # a generator of chunks when streaming the output
+                return Response(generated_data, 200, headers)
             return generated_data, 200, headers
 
         # apply any user supplied decorators, like authentication
@@ -308,20 +858,162 @@ class PrometheusMetrics:
             (both `str` types)
         """
 
-        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
-            registry = CollectorRegistry()
+        generated_content, content_type = self._generate_metrics_output(accept_header, names)
+        return generated_content.decode('utf-8'), content_type
+
+    def _generate_metrics_output(self, accept_header, names, content_encoding=None, stream=False):
+        """
+        Generate the encoded metrics output, or return it from the cache
+        when `metrics_cache_ttl` is set and the output for the same
+        encoding and names is still fresh.
+
+        :param content_encoding: the compression to apply
+            to the output, like `gzip`, or `None` to leave it uncompressed
+        :param stream: return a generator of the output chunks,
+            one for each metric family, unless the output is cached
+        :return: a tuple of response content (as `bytes`,
+            or a generator of `bytes` when streaming)
+            and response content type
+        """
+
+        generate_latest, content_type = choose_encoder(accept_header)
+
+        def generate():
+            if self._rendered_families is not None and not names:
+                return b''.join(self._render_metrics(generate_latest, content_type, names))
+
+            return generate_latest(self._metrics_registry(names))
+
+        def compress(output):
+            return _compress_output(output, content_encoding, self._compress_level)
+
+        if self._metrics_cache is None:
+            if stream:
+                return self._stream_metrics_output(
+                    generate_latest, content_type, names, content_encoding
+                ), content_type
+            if content_encoding:
+                return compress(generate()), content_type
+            return generate(), content_type
+
+        cache_key = (content_type, tuple(sorted(set(names))) if names else None)
+        if not content_encoding:
+            return self._metrics_cache.get(cache_key, generate), content_type
+
+        # compress the cached uncompressed output, so that it is generated
+        # only once for all the encodings, and compressed once per encoding,
+        # the compressed outputs expire with the uncompressed one
+        return self._metrics_cache.get(
+            cache_key, generate, variant=content_encoding, derive=compress
+        ), content_type
+
+    def _stream_metrics_output(self, generate_latest, content_type, names, content_encoding=None):
+        """
+        Generate the encoded metrics output one metric family at a time,
+        so that only a single rendered family is kept in memory at once.
+
+        :param generate_latest: the function to render the output format
+        :param content_type: the content type of the output format
+        :param names: names to only return samples for, or `None`
+        :param content_encoding: the compression to apply
+            to the output, like `gzip`, or `None` to leave it uncompressed
+        :return: a generator of the output chunks (as `bytes`)
+        """
+
+        compressor = None
+        if content_encoding:
+            compressor = _compressor(content_encoding, self._compress_level)
+
+        for chunk in self._render_metrics(generate_latest, content_type, names):
+            if compressor:
+                chunk = compressor.compress(chunk)
+
+            if chunk:
+                yield chunk
+
+        if compressor:
+            yield compressor.flush()
+
+    def _render_metrics(self, generate_latest, content_type, names):
+        """
+        Render the metrics output one metric family at a time,
+        reusing the previous output of families that did not change
+        when `cache_rendered_families` is enabled.
+
+        :param generate_latest: the function to render the output format
+        :param content_type: the content type of the output format
+        :param names: names to only return samples for, or `None`
+        :return: a generator of the rendered families (as `bytes`),
+            followed by the trailer of the output format
+        """
+
+        # some formats end with a trailer, like `# EOF` for OpenMetrics,
+        # that should only be written once, at the end of the whole output
+        trailer = generate_latest(_MetricFamilies([]))
+
+        families = self._metrics_registry(names).collect()
+
+        if self._rendered_families is not None and not names:
+            yield from self._rendered_families.render(generate_latest, content_type, families, trailer)
+        else:
+            for family in families:
+                yield _render_family(generate_latest, family, trailer)
+
+        yield trailer
+
+    def _metrics_registry(self, names):
+        """
+        Returns the registry (or collector) to generate the metrics output from.
+        In multiprocess mode, this is a registry merging the metrics
+        of all processes, created on first use, then reused.
+        Restricted views of the registry for `name[]` filters are also reused.
+
+        :param names: names to only return samples for, or `None`
+        """
+
+        if self._multiprocess:
+            registry = self._multiprocess_registry or self._create_multiprocess_registry()
         else:
             registry = self.registry
 
-        if names:
-            registry = registry.restricted_registry(names)
+        if not names:
+            return registry
 
-        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
-            pc_multiprocess.MultiProcessCollector(registry)
+        cache_key = (registry, tuple(sorted(set(names))))
 
-        generate_latest, content_type = choose_encoder(accept_header)
-        generated_content = generate_latest(registry).decode('utf-8')
-        return generated_content, content_type
+        restricted = self._restricted_registries.get(cache_key)
+        if restricted is None:
+            restricted = registry.restricted_registry(names)
+
+            with self._registry_lock:
+                # the filters come from the requests, so don't let them grow unbounded
+                if len(self._restricted_registries) >= _RESTRICTED_REGISTRIES_CACHE_SIZE:
+                    self._restricted_registries.clear()
+
+                self._restricted_registries[cache_key] = restricted
+
+        return restricted
+
+    def _create_multiprocess_registry(self):
+        """
+        Create the registry with a collector merging the metrics
+        of all processes, or return it if it was created already.
+        """
+
+        with self._registry_lock:
+            if self._multiprocess_registry is None:
+                try:
+                    # include the (nameless) multiprocess collector in restricted views
+                    registry = CollectorRegistry(support_collectors_without_names=True)
+                except TypeError:
+                    # prometheus-client < 0.21.0
+                    registry = CollectorRegistry()
+
+                from .multiprocess import _create_collector
+                _create_collector(registry, **self._multiprocess_options)
+                self._multiprocess_registry = registry
+
+            return self._multiprocess_registry
 
     def start_http_server(self, port, host='0.0.0.0', endpoint='/metrics', ssl=None):
         """
@@ -356,8 +1048,8 @@ class PrometheusMetrics:
         thread.start()
 
     def export_defaults(self, buckets=None, group_by='path',
-                        latency_as_histogram=True,
-                        prefix='flask', app=None, **kwargs):
+                        latency_as_histogram=True, cache_children=False,
+                        prefix='flask', app=None, mode='flask', **kwargs):
         """
         Export the default metrics:
             - HTTP request latencies
@@ -372,9 +1064,16 @@ class PrometheusMetrics:
         :param latency_as_histogram: export request latencies
             as a Histogram, otherwise use a Summary instead
             (defaults to `True` to export as a Histogram)
+        :param cache_children: cache the labeled children of the metrics
+            by their label values, so that repeated label combinations
+            don't need to be looked up on the metrics again
+            (defaults to `False`)
         :param prefix: prefix to start the default metrics names with
             or `NO_PREFIX` (to skip prefix)
         :param app: the Flask application
+        :param mode: `flask` to measure requests with Flask request callbacks,
+            or `wsgi` to measure them by wrapping the WSGI application
+            (defaults to `flask`)
         """
 
         if app is None:
@@ -409,6 +1108,15 @@ class PrometheusMetrics:
         else:
             prefix = prefix + "_"
 
+        labels = self._get_combined_labels(None)
+        labels_use_response = labels.has_response_values()
+
+        if mode == 'wsgi' and labels_use_response:
+            raise ValueError(
+                'Default labels using the response are not supported '
+                'when measuring requests in `wsgi` mode'
+            )
+
         try:
             self.info(
                 '%sexporter_info' % prefix,
@@ -418,15 +1126,13 @@ class PrometheusMetrics:
         except ValueError:
             return  # looks like we have already exported the default metrics
 
-        labels = self._get_combined_labels(None)
-
         if latency_as_histogram:
             # use the default buckets from prometheus_client if not given here
             buckets_as_kwargs = {}
             if buckets is not None:
                 buckets_as_kwargs['buckets'] = buckets
 
-            request_duration_metric = Histogram(
+            request_duration_metric = self._metric_type(Histogram)(
                 '%shttp_request_duration_seconds' % prefix,
                 'Flask HTTP request duration in seconds',
                 ('method', duration_group_name, 'status') + labels.keys(),
@@ -436,7 +1142,7 @@ class PrometheusMetrics:
 
         else:
             # export as Summary instead
-            request_duration_metric = Summary(
+            request_duration_metric = self._metric_type(Summary)(
                 '%shttp_request_duration_seconds' % prefix,
                 'Flask HTTP request duration in seconds',
                 ('method', duration_group_name, 'status') + labels.keys(),
@@ -444,92 +1150,196 @@ class PrometheusMetrics:
             )
 
         counter_labels = ('method', 'status') + labels.keys()
-        request_total_metric = Counter(
+        request_total_metric = self._metric_type(Counter)(
             '%shttp_request_total' % prefix,
             'Total number of HTTP requests',
             counter_labels,
             registry=self.registry
         )
 
-        request_exceptions_metric = Counter(
+        request_exceptions_metric = self._metric_type(Counter)(
             '%shttp_request_exceptions_total' % prefix,
             'Total number of HTTP requests which resulted in an exception',
             counter_labels,
             registry=self.registry
         )
 
+        if cache_children:
+            duration_children, total_children, exceptions_children = {}, {}, {}
+        else:
+            duration_children = total_children = exceptions_children = None
+
+        def child_of(metric, children, label_values):
+            if children is None:
+                return metric.labels(*label_values)
+
+            try:
+                return children[label_values]
+            except KeyError:
+                child = children[label_values] = metric.labels(*label_values)
+                return child
+            except TypeError:
+                # unhashable label values can't be cached
+                return metric.labels(*label_values)
+
+        def group_of(req):
+            if callable(duration_group):
+                group = duration_group(req)
+            else:
+                group = getattr(req, duration_group)
+
+            if cache_children:
+                # the label value will be converted to a string anyway,
+                # and some request properties, like `url_rule`, are not hashable
+                return str(group)
+            else:
+                return group
+
+        if mode == 'wsgi':
+            def track_request(status):
+                # invoked within the request context
+                tracking = _request_tracking()
+
+                if tracking.do_not_track or tracking.exclude_all or self._is_excluded():
+                    tracking.wsgi_labels = None
+                else:
+                    label_values = tuple(labels.values_for(None, tracking.label_snapshot).values())
+                    tracking.wsgi_labels = (request.method, group_of(request), status, label_values)
+
+            def track_exception(sender, exception, **extra):
+                _request_tracking().exception = True
+                track_request(500)
+
+            def report(tracking, raised=False):
+                if not tracking.wsgi_labels:
+                    return
+
+                method, group, status, label_values = tracking.wsgi_labels
+                if raised:
+                    status = 500
+
+                total_time = max(default_timer() - tracking.start_time, 0)
+
+                child_of(
+                    request_duration_metric, duration_children,
+                    (method, group, status) + label_values
+                ).observe(total_time)
+
+                child_of(
+                    request_total_metric, total_children,
+                    (method, status) + label_values
+                ).inc()
+
+                if raised or tracking.exception:
+                    child_of(
+                        request_exceptions_metric, exceptions_children,
+                        (method, 500) + label_values
+                    ).inc()
+
+            def middleware(wsgi_app):
+                @wraps(wsgi_app)
+                def measured_wsgi_app(environ, start_response):
+                    tracking = environ[_TRACKING_KEY] = _RequestTracking()
+                    tracking.start_time = default_timer()
+
+                    def start_response_with_status(status, headers, *args):
+                        if has_request_context():
+                            track_request(int(status.split(' ', 1)[0]))
+
+                        return start_response(status, headers, *args)
+
+                    try:
+                        app_iter = wsgi_app(environ, start_response_with_status)
+                    except Exception:
+                        report(tracking, raised=True)
+                        raise
+
+                    # report when the server is done with sending the response body
+                    return ClosingIterator(app_iter, lambda: report(tracking))
+
+                return measured_wsgi_app
+
+            app.wsgi_app = middleware(app.wsgi_app)
+
+            try:
+                got_request_exception.connect(track_exception, app, weak=False)
+            except RuntimeError:
+                # older Flask versions without `blinker` installed don't support signals,
+                # only count the exceptions propagated to the WSGI server then
+                pass
+
+            return
+
         def before_request():
-            request.prom_start_time = default_timer()
+            _request_tracking().start_time = default_timer()
 
         def after_request(response):
-            if hasattr(request, 'prom_do_not_track') or hasattr(request, 'prom_exclude_all'):
+            tracking = _request_tracking()
+
+            if tracking.do_not_track or tracking.exclude_all:
                 return response
 
-            if self.excluded_paths:
-                if any(pattern.match(request.path) for pattern in self.excluded_paths):
-                    return response
+            if self._is_excluded():
+                return response
 
-            if hasattr(request, 'prom_start_time') and self._not_yet_handled('duration_reported'):
-                total_time = max(default_timer() - request.prom_start_time, 0)
+            label_values = tuple(labels.values_for(response, tracking.label_snapshot).values())
+            status = _to_status_code(response.status_code)
 
-                if callable(duration_group):
-                    group = duration_group(request)
-                else:
-                    group = getattr(request, duration_group)
+            if tracking.start_time is not None and not tracking.duration_reported:
+                tracking.duration_reported = True
+                total_time = max(default_timer() - tracking.start_time, 0)
 
-                request_duration_labels = {
-                    'method': request.method,
-                    'status': _to_status_code(response.status_code),
-                    duration_group_name: group
-                }
-                request_duration_labels.update(labels.values_for(response))
+                child_of(
+                    request_duration_metric, duration_children,
+                    (request.method, group_of(request), status) + label_values
+                ).observe(total_time)
 
-                request_duration_metric.labels(**request_duration_labels).observe(total_time)
+            if not tracking.total_reported:
+                tracking.total_reported = True
 
-            if self._not_yet_handled('total_reported'):
-                request_total_metric.labels(
-                    method=request.method, status=_to_status_code(response.status_code),
-                    **labels.values_for(response)
+                child_of(
+                    request_total_metric, total_children,
+                    (request.method, status) + label_values
                 ).inc()
 
             return response
 
         def teardown_request(exception=None):
-            if not exception or hasattr(request, 'prom_do_not_track') or hasattr(request, 'prom_exclude_all'):
+            if not exception:
                 return
 
-            if self.excluded_paths:
-                if any(pattern.match(request.path) for pattern in self.excluded_paths):
-                    return
+            tracking = _request_tracking()
 
-            response = make_response('Exception: %s' % exception, 500)
+            if tracking.do_not_track or tracking.exclude_all:
+                return
 
-            if callable(duration_group):
-                group = duration_group(request)
-            else:
-                group = getattr(request, duration_group)
+            if self._is_excluded():
+                return
 
-            request_exceptions_metric.labels(
-                method=request.method, status=500,
-                **labels.values_for(response)
+            # only the default labels using the response need one
+            response = make_response('Exception: %s' % exception, 500) if labels_use_response else None
+            label_values = tuple(labels.values_for(response, tracking.label_snapshot).values())
+
+            child_of(
+                request_exceptions_metric, exceptions_children,
+                (request.method, 500) + label_values
             ).inc()
 
-            if hasattr(request, 'prom_start_time') and self._not_yet_handled('duration_reported'):
-                total_time = max(default_timer() - request.prom_start_time, 0)
+            if tracking.start_time is not None and not tracking.duration_reported:
+                tracking.duration_reported = True
+                total_time = max(default_timer() - tracking.start_time, 0)
 
-                request_duration_labels = {
-                    'method': request.method,
-                    'status': 500,
-                    duration_group_name: group
-                }
-                request_duration_labels.update(labels.values_for(response))
+                child_of(
+                    request_duration_metric, duration_children,
+                    (request.method, group_of(request), 500) + label_values
+                ).observe(total_time)
 
-                request_duration_metric.labels(**request_duration_labels).observe(total_time)
+            if not tracking.total_reported:
+                tracking.total_reported = True
 
-            if self._not_yet_handled('total_reported'):
-                request_total_metric.labels(
-                    method=request.method, status=500,
-                    **labels.values_for(response)
+                child_of(
+                    request_total_metric, total_children,
+                    (request.method, 500) + label_values
                 ).inc()
 
             return
@@ -653,6 +1463,20 @@ class PrometheusMetrics:
             registry=self.registry
         )
 
+    def _metric_type(self, metric_type):
+        """
+        Returns the metric type to create the default metrics
+        and the metrics of the decorators with, the sharded variant
+        of the type, when enabled and not in multiprocess mode.
+
+        :param metric_type: the type of the metric from the `prometheus_client` library
+        """
+
+        if self._sharded_metrics and not values.ValueClass._multiprocess:
+            return _SHARDED_METRIC_TYPES.get(metric_type, metric_type)
+
+        return metric_type
+
     def _track(self, metric_type, metric_call, metric_kwargs, name, description, labels,
                initial_value_when_only_static_labels, registry, before=None, revert_when_not_tracked=None):
         """
@@ -679,28 +1503,81 @@ class PrometheusMetrics:
 
         labels = self._get_combined_labels(labels)
 
-        parent_metric = metric_type(
+        parent_metric = self._metric_type(metric_type)(
             name, description, labelnames=labels.keys(), registry=registry,
             **metric_kwargs
         )
 
-        # When all labels are already known at this point, the metric can get an initial value.
-        if initial_value_when_only_static_labels and labels.has_keys() and labels.has_only_static_values():
-            parent_metric.labels(*labels.get_default_values())
+        only_static_labels = labels.has_only_static_values()
 
-        def get_metric(response):
-            if labels.has_keys():
-                return parent_metric.labels(**labels.values_for(response))
-            else:
-                return parent_metric
+        if not labels.has_keys():
+            bound_metric = parent_metric
+
+        elif only_static_labels and initial_value_when_only_static_labels:
+            # When all labels are already known at this point, the metric can get an initial value.
+            bound_metric = parent_metric.labels(*labels.get_default_values())
+
+        else:
+            bound_metric = None
+
+        def get_metric(response, snapshot=None):
+            nonlocal bound_metric
+
+            if bound_metric is not None:
+                return bound_metric
+
+            if only_static_labels:
+                # bind the child on first use when it should not get an initial value
+                bound_metric = parent_metric.labels(*labels.get_default_values())
+                return bound_metric
+
+            return parent_metric.labels(**labels.values_for(response, snapshot))
 
         def decorator(f):
+            converted_by_view_function = {}
+
+            def converts_response(view_func):
+                """
+                Whether the response of `f` needs converting when it is
+                registered (possibly wrapped) as this view function.
+                This only depends on how the decorators were applied,
+                so the result is cached for each view function.
+                """
+
+                try:
+                    return converted_by_view_function[view_func]
+                except KeyError:
+                    pass
+
+                registered = view_func
+
+                # There may be decorators 'above' us,
+                # but before the function is registered with Flask
+                while view_func and view_func != f:
+                    try:
+                        view_func = view_func.__wrapped__
+                    except AttributeError:
+                        break
+
+                if view_func == f:
+                    # we are in a request handler method
+                    converts = True
+
+                elif hasattr(view_func, 'view_class') and issubclass(view_func.view_class, MethodView):
+                    # we are in a method view (for Flask-RESTful for example)
+                    converts = True
+
+                else:
+                    converts = False
+
+                converted_by_view_function[registered] = converts
+                return converts
+
             @wraps(f)
             def func(*args, **kwargs):
-                if self.exclude_user_defaults and self.excluded_paths:
+                if self.exclude_user_defaults and self._is_excluded():
                     # exclude based on default excludes
-                    if any(pattern.match(request.path) for pattern in self.excluded_paths):
-                        return f(*args, **kwargs)
+                    return f(*args, **kwargs)
 
                 if before:
                     metric = get_metric(None)
@@ -724,7 +1601,7 @@ class PrometheusMetrics:
                     exception = ex
                     response = make_response(f'Exception: {ex}', 500)
 
-                if hasattr(request, 'prom_exclude_all'):
+                if _request_tracking().exclude_all:
                     if metric and revert_when_not_tracked:
                         # special handling for Gauge metrics
                         revert_when_not_tracked(metric)
@@ -735,25 +1612,10 @@ class PrometheusMetrics:
 
                 if not metric:
                     if not isinstance(response, Response) and request.endpoint:
-                        view_func = current_app.view_functions[request.endpoint]
-
-                        # There may be decorators 'above' us,
-                        # but before the function is registered with Flask
-                        while view_func and view_func != f:
-                            try:
-                                view_func = view_func.__wrapped__
-                            except AttributeError:
-                                break
-
-                        if view_func == f:
-                            # we are in a request handler method
-                            response = self._response_converter(response)
-
-                        elif hasattr(view_func, 'view_class') and issubclass(view_func.view_class, MethodView):
-                            # we are in a method view (for Flask-RESTful for example)
+                        if converts_response(current_app.view_functions[request.endpoint]):
                             response = self._response_converter(response)
 
-                    metric = get_metric(response)
+                    metric = get_metric(response, _request_tracking().label_snapshot)
 
                 metric_call(metric, time=total_time)
 
@@ -783,49 +1645,7 @@ class PrometheusMetrics:
         if self._default_labels:
             labels.update(self._default_labels.copy())
 
-        def argspec(func):
-            if hasattr(inspect, 'getfullargspec'):
-                return inspect.getfullargspec(func)
-            else:
-                return inspect.getargspec(func)
-
-        def label_value(f):
-            if not callable(f):
-                return lambda x: f
-            if argspec(f).args:
-                return lambda x: f(x)
-            else:
-                return lambda x: f()
-
-        class CombinedLabels:
-            def __init__(self, _labels):
-                self.labels = _labels.items()
-
-            def keys(self):
-                return tuple(map(lambda k: k[0], self.labels))
-
-            def has_keys(self):
-                return len(self.labels) > 0
-
-            def has_only_static_values(self):
-                for key, value in self.labels:
-                    if callable(value):
-                        return False
-
-                return True
-
-            def get_default_values(self):
-                return list(value for key, value in self.labels)
-
-            def values_for(self, response):
-                label_generator = tuple(
-                    (key, label_value(call))
-                    for key, call in self.labels
-                ) if labels else tuple()
-
-                return {key: value(response) for key, value in label_generator}
-
-        return CombinedLabels(labels)
+        return _CombinedLabels(labels)
 
     @staticmethod
     def do_not_track():
@@ -838,7 +1658,7 @@ class PrometheusMetrics:
         def decorator(f):
             @wraps(f)
             def func(*args, **kwargs):
-                request.prom_do_not_track = True
+                _request_tracking().do_not_track = True
                 return f(*args, **kwargs)
 
             return func
@@ -854,7 +1674,7 @@ class PrometheusMetrics:
         def decorator(f):
             @wraps(f)
             def func(*args, **kwargs):
-                request.prom_exclude_all = True
+                _request_tracking().exclude_all = True
                 return f(*args, **kwargs)
 
             return func
@@ -917,31 +1737,86 @@ class PrometheusMetrics:
 
         return gauge
 
-    @staticmethod
-    def _is_string(value):
-        try:
-            return isinstance(value, str)  # python3
-        except NameError:
-            return isinstance(value, basestring)  # python2
+    def _is_excluded(self):
+        """
+        Check if the current request is excluded from tracking
+        by its endpoint, URL rule or path.
+
+        :return: `True` if the request should not be tracked
+        """
+
+        if self.excluded_endpoints and request.endpoint in self.excluded_endpoints:
+            return True
+
+        if self.excluded_rules and request.url_rule is not None:
+            if request.url_rule.rule in self.excluded_rules:
+                return True
+
+        if self._is_excluded_path:
+            return self._is_excluded_path(request.path)
+
+        return False
 
     @staticmethod
-    def _not_yet_handled(tracking_key):
+    def _create_excluded_path_matcher(excluded_paths):
         """
-        Check if the request has not handled some tracking yet,
-        and mark the request if this is the first time.
-        This is to avoid follow-up actions.
+        Creates a function to check if a path is excluded from tracking.
+        The patterns are merged into a single regular expression when
+        possible, and the results are cached for a limited number of paths.
 
-        :param tracking_key: a key identifying a processing step
-        :return: True if this is the first time the request is
-          trying to handle this processing step
+        :param excluded_paths: the list of compiled patterns or `None`
+        :return: a function returning `True` for excluded paths,
+            or `None` if there are no exclusions
         """
 
-        key = f'prom_{tracking_key}'
-        if hasattr(request, key):
-            return False
-        else:
-            setattr(request, key, True)
-            return True
+        if not excluded_paths:
+            return None
+
+        def match_any(path):
+            return any(pattern.match(path) for pattern in excluded_paths)
+
+        match = match_any
+
+        # numbered groups (and backreferences to them) would change
+        # their meaning when the patterns are merged together,
+        # and the merged pattern can only have one set of flags
+        flags = excluded_paths[0].flags
+        if len(excluded_paths) > 1 and all(pattern.groups == 0 and pattern.flags == flags
+                                           for pattern in excluded_paths):
+            try:
+                match = re.compile(
+                    '|'.join('(?:%s)' % pattern.pattern for pattern in excluded_paths), flags
+                ).match
+            except re.error:
+                pass  # for example, patterns with global inline flags
+
+        # a plain dictionary rather than an LRU cache, so cache hits don't
+        # reorder (and lock) shared state when the GIL is disabled,
+        # it starts over when it's full
+        cache = {}
+
+        def is_excluded(path):
+            try:
+                return cache[path]
+            except KeyError:
+                pass
+
+            result = bool(match(path))
+
+            if len(cache) >= _EXCLUDED_PATHS_CACHE_SIZE:
+                cache.clear()
+
+            cache[path] = result
+            return result
+
+        return is_excluded
+
+    @staticmethod
+    def _is_string(value):
+        try:
+            return isinstance(value, str)  # python3
+        except NameError:
+            return isinstance(value, basestring)  # python2
 
 
 class ConnexionPrometheusMetrics(PrometheusMetrics):
@@ -970,7 +1845,7 @@ class ConnexionPrometheusMetrics(PrometheusMetrics):
         def decorator(f):
             @wraps(f)
             def func(*args, **kwargs):
-                request.prom_connexion_content_type = content_type
+                _request_tracking().connexion_content_type = content_type
                 return f(*args, **kwargs)
             return func
         return decorator
@@ -980,9 +1855,7 @@ class ConnexionPrometheusMetrics(PrometheusMetrics):
         def _make_response(response):
             from connexion.apis.flask_api import FlaskApi
 
-            mimetype = default_mimetype
-            if hasattr(request, 'prom_connexion_content_type'):
-                mimetype = request.prom_connexion_content_type
+            mimetype = _request_tracking().connexion_content_type or default_mimetype
 
             return FlaskApi.get_response(response, mimetype=mimetype)
         return _make_response
@@ -1,23 +1,107 @@
+import atexit
+import glob
+import inspect
+import itertools
+import json
+import logging
+import mmap
 import os
+import select
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from timeit import default_timer
 
 from prometheus_client import CollectorRegistry
 from prometheus_client import start_http_server as pc_start_http_server
+from prometheus_client import values
+from prometheus_client.metrics_core import Metric
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
 from prometheus_client.multiprocess import MultiProcessCollector
 from prometheus_client.multiprocess import mark_process_dead as pc_mark_process_dead
+from werkzeug.wsgi import ClosingIterator
 
 from . import PrometheusMetrics
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, the compaction is not synchronized with scrapes there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_pack_integer = struct.Struct('i').pack
+_pack_two_doubles = struct.Struct('dd').pack
+_unpack_integer = struct.Struct('i').unpack_from
+_unpack_two_integers = struct.Struct('ii').unpack_from
+_unpack_two_doubles = struct.Struct('dd').unpack_from
+
+# the times when process IDs were marked dead in this process, see `mark_process_dead`
+_dead_processes = {}
+
+# the metric types with values that can be summed up across processes
+_COMPACTED_TYPES = ('counter', 'histogram', 'summary')
+
+# the process identifier in the names of the files with the compacted values
+_ARCHIVE_ID = 'archive'
+
+_COMPACTION_LOCK_FILE = '.compaction.lock'
+
+# whether the metrics files have a timestamp next to each value (prometheus-client >= 0.18.0),
+# the layout parsed by `IncrementalMultiProcessCollector` and written by `compact_process_files`
+_TIMESTAMPED_FILES = 'timestamp' in inspect.signature(MmapedDict.write_value).parameters
+
+_TIMESTAMPED_FILES_REQUIRED = 'this needs prometheus-client 0.18.0 or later'
+
+# the function naming the metrics files of the processes, see `_use_process_identifier`
+_process_identifier = os.getpid
+
+# whether the metrics files are written in batches, see `_use_batched_writes`
+_batched_writes = False
+
+# the arbiter process ID and the slot of the Gunicorn worker forked last
+_gunicorn_forked_slot = None
+
+# the Gunicorn workers by their allocated slots, in the arbiter process
+_gunicorn_slots = {}
+
+# the shared memory segment with the metric values of the workers, see `_use_shared_memory`
+_shared_memory = None
+
+_DEFAULT_SHARED_MEMORY_SLOT_SIZE = 1024 * 1024
+
+# the aggregator of the metric values sent by the processes, see `_use_aggregator`
+_aggregator = None
+
+# the header of the datagrams sent to the aggregator: the process ID and the flags,
+# then the records of the series: the series ID, the value, the timestamp,
+# and the length of the key that follows (only when the series is sent first)
+_AGGREGATOR_HEADER = struct.Struct('<iB')
+_AGGREGATOR_RECORD = struct.Struct('<IddH')
+_AGGREGATOR_NEW_PROCESS = 1
+_AGGREGATOR_DATAGRAM_SIZE = 16 * 1024
+
 
 def _check_multiproc_env_var():
     """
     Checks that the `PROMETHEUS_MULTIPROC_DIR` environment variable is set,
-    which is required for the multiprocess collector to work properly.
+    which is required for the multiprocess collector to work properly,
+    unless the metric values are kept in shared memory, or sent to an aggregator instead.
 
     :raises ValueError: if the environment variable is not set
         or if it does not point to a directory
     """
 
+    if _shared_memory is not None or _aggregator is not None:
+        return
+
     if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
         if os.path.isdir(os.environ['PROMETHEUS_MULTIPROC_DIR']):
             return
@@ -29,6 +113,1465 @@ def _check_multiproc_env_var():
         'must be set and be a directory')
 
 
+def _multiproc_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+
+
+@contextmanager
+def _directory_lock(path, exclusive=False):
+    """
+    Lock the multiprocess directory, exclusively for marking processes dead
+    and compacting their files, or shared for reading them, so that scrapes never
+    see the values of a compacted process both in its own files and in the archive
+    files, and concurrent sweeps don't remove the same files.
+
+    The exclusive lock creates the lock file, the shared lock only uses it when
+    it exists already, so directories without compactions are read without it.
+    Yields `True` when the directory is locked, `False` when the lock file
+    is missing, and `None` when the lock file can't be opened.
+    """
+
+    if fcntl is None:
+        yield True
+        return
+
+    try:
+        lock_file = open(os.path.join(path, _COMPACTION_LOCK_FILE), 'a+b' if exclusive else 'rb')
+    except FileNotFoundError:
+        if exclusive:
+            raise
+
+        # nothing was compacted in this directory (yet)
+        yield False
+        return
+    except OSError:
+        if exclusive:
+            raise
+
+        # a read-only directory (or one owned by another user) can't be
+        # compacted by this process, read the files without the lock then
+        yield None
+        return
+
+    with lock_file:
+        # closing the file releases the lock
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield True
+
+
+def _use_process_identifier(process_identifier):
+    """
+    Name the metrics files of the processes created from now on
+    by the given process identifier function, instead of by process IDs.
+    The metrics created before this call keep using their current files.
+    """
+
+    global _process_identifier
+
+    _process_identifier = process_identifier = _claiming_process_identifier(process_identifier)
+
+    if _batched_writes:
+        values.ValueClass = _batched_multiprocess_value(process_identifier)
+    else:
+        values.ValueClass = values.MultiProcessValue(process_identifier=process_identifier)
+
+
+def _claiming_process_identifier(process_identifier):
+    """
+    Wrap a process identifier function naming the metrics files by worker slots
+    or worker IDs, to remove the live gauge (and `all` mode gauge) files left
+    behind by the previous worker of the slot, like one that crashed,
+    when a process first uses the slot, before it opens any of the files.
+    """
+
+    claimed = {'value': None}
+    lock = threading.Lock()
+
+    def claiming_process_identifier():
+        identifier = process_identifier()
+        pid = os.getpid()
+
+        if claimed['value'] != (pid, identifier):
+            with lock:
+                if claimed['value'] != (pid, identifier):
+                    if identifier != str(pid):
+                        _remove_gauge_files(identifier)
+
+                    claimed['value'] = (pid, identifier)
+
+        return identifier
+
+    return claiming_process_identifier
+
+
+def _remove_gauge_files(identifier):
+    """
+    Remove the files of the gauges of a worker slot that only
+    belong to the process that wrote them.
+    """
+
+    path = _multiproc_dir()
+    if not path:
+        return
+
+    while True:
+        try:
+            pc_mark_process_dead(identifier, path)
+            break
+        except FileNotFoundError:
+            continue
+
+    try:
+        os.remove(os.path.join(path, 'gauge_all_%s.db' % identifier))
+    except FileNotFoundError:
+        pass
+
+
+def _use_batched_writes():
+    """
+    Write the counter, histogram and summary values of the metrics
+    created from now on into the metrics files in batches.
+    The metrics created before this call keep writing their values immediately.
+    """
+
+    global _batched_writes
+
+    if not _TIMESTAMPED_FILES:
+        raise RuntimeError('Batched writes are not supported, ' + _TIMESTAMPED_FILES_REQUIRED)
+
+    _batched_writes = True
+    values.ValueClass = _batched_multiprocess_value(_process_identifier)
+
+
+def _batched_multiprocess_value(process_identifier=os.getpid):
+    """
+    Returns a value class for `prometheus_client`, like `MultiProcessValue`,
+    that keeps the changes of counters, histograms and summaries made in
+    a thread in memory while a batch is started in it, then writes them into
+    the metrics files at once when the batch is applied, holding the lock once.
+    Gauges are written immediately, so they show the changes while in a batch.
+
+    :param process_identifier: the function returning the ID of the current process
+    """
+
+    files = {}
+    created = []
+    pid = {'value': process_identifier()}
+    lock = threading.Lock()
+    batches = threading.local()
+
+    class BatchedMmapedValue:
+        """A float protected by a mutex backed by a per-process mmaped file, changed in batches."""
+
+        _multiprocess = True
+
+        def __init__(self, typ, metric_name, name, labelnames, labelvalues, help_text,
+                     multiprocess_mode='', **kwargs):
+            self._params = typ, metric_name, name, labelnames, labelvalues, help_text, multiprocess_mode
+            self._batched = typ != 'gauge'
+
+            with lock:
+                self._check_for_pid_change()
+                self._reset()
+                created.append(self)
+
+        def _reset(self):
+            typ, metric_name, name, labelnames, labelvalues, help_text, multiprocess_mode = self._params
+
+            if typ == 'gauge':
+                file_prefix = typ + '_' + multiprocess_mode
+            else:
+                file_prefix = typ
+
+            if file_prefix not in files:
+                filename = os.path.join(_multiproc_dir(), '%s_%s.db' % (file_prefix, pid['value']))
+                files[file_prefix] = MmapedDict(filename)
+
+            self._file = files[file_prefix]
+            self._key = mmap_key(metric_name, name, labelnames, labelvalues, help_text)
+            self._value, self._timestamp = self._file.read_value(self._key)
+
+        def _check_for_pid_change(self):
+            actual_pid = process_identifier()
+            if pid['value'] != actual_pid:
+                pid['value'] = actual_pid
+                # there has been a fork, reset all the values
+                for f in files.values():
+                    f.close()
+                files.clear()
+
+                for value in created:
+                    value._reset()
+
+        def inc(self, amount):
+            pending = getattr(batches, 'pending', None)
+            if pending is not None and self._batched:
+                pending[self] = pending.get(self, 0.0) + amount
+                return
+
+            with lock:
+                self._check_for_pid_change()
+                self._value += amount
+                self._timestamp = 0.0
+                self._file.write_value(self._key, self._value, self._timestamp)
+
+        def set(self, value, timestamp=None):
+            with lock:
+                self._check_for_pid_change()
+                # drop the increments in the batch made before setting the value
+                (getattr(batches, 'pending', None) or {}).pop(self, None)
+                self._value = value
+                self._timestamp = timestamp or 0.0
+                self._file.write_value(self._key, self._value, self._timestamp)
+
+        def set_exemplar(self, exemplar):
+            # not supported in multiprocess mode
+            return
+
+        def get(self):
+            with lock:
+                self._check_for_pid_change()
+                return self._value + (getattr(batches, 'pending', None) or {}).get(self, 0.0)
+
+        def get_exemplar(self):
+            # not supported in multiprocess mode
+            return None
+
+        @classmethod
+        def start_batch(cls):
+            """
+            Keep the changes made in the current thread in memory,
+            until `apply_batch` is called.
+            """
+
+            batches.depth = getattr(batches, 'depth', 0) + 1
+            if batches.depth == 1:
+                batches.pending = {}
+
+        @classmethod
+        def apply_batch(cls):
+            """
+            Write the changes made in the current thread since `start_batch`
+            into the metrics files.
+            """
+
+            batches.depth -= 1
+            if batches.depth > 0:
+                return
+
+            pending = batches.pending
+            batches.pending = None
+
+            if not pending:
+                return
+
+            with lock:
+                # resets all the values after a fork, so check it once
+                next(iter(pending))._check_for_pid_change()
+
+                for value, amount in pending.items():
+                    value._value += amount
+                    value._timestamp = 0.0
+                    value._file.write_value(value._key, value._value, value._timestamp)
+
+    return BatchedMmapedValue
+
+
+def _batched_writes_middleware(wsgi_app, value_class):
+    """
+    Wrap the WSGI application to write the metrics changed while handling
+    a request in a single batch, when the server is done with the response.
+    """
+
+    def batched_wsgi_app(environ, start_response):
+        value_class.start_batch()
+
+        try:
+            app_iter = wsgi_app(environ, start_response)
+        except BaseException:
+            value_class.apply_batch()
+            raise
+
+        return ClosingIterator(app_iter, value_class.apply_batch)
+
+    return batched_wsgi_app
+
+
+def _gunicorn_worker_slot():
+    """
+    Returns the worker slot of a Gunicorn worker process,
+    or `None` in any other process, like the arbiter.
+    """
+
+    # only the processes forked by the arbiter directly are workers
+    if _gunicorn_forked_slot is not None and os.getppid() == _gunicorn_forked_slot[0]:
+        return _gunicorn_forked_slot[1]
+
+    return None
+
+
+def _gunicorn_process_identifier():
+    """
+    Returns the worker slot of a Gunicorn worker process,
+    or the process ID in any other process, like the arbiter.
+    """
+
+    slot = _gunicorn_worker_slot()
+    if slot is not None:
+        return 'slot%d' % slot
+
+    return str(os.getpid())
+
+
+def _uwsgi_worker_slot():
+    """
+    Returns the (zero-based) worker slot of a uWSGI worker process,
+    or `None` in any other process, like the master.
+    """
+
+    import uwsgi
+
+    worker_id = uwsgi.worker_id()
+    if worker_id > 0:
+        return worker_id - 1
+
+    return None
+
+
+def _uwsgi_process_identifier():
+    """
+    Returns the worker ID of a uWSGI worker process,
+    or the process ID in any other process, like the master.
+    """
+
+    slot = _uwsgi_worker_slot()
+    if slot is not None:
+        return 'worker%d' % (slot + 1)
+
+    return str(os.getpid())
+
+
+def mark_process_dead(pid, path=None, compact=False):
+    """
+    Do the bookkeeping of the Prometheus client library for a process
+    that has exited, and let the collectors in this process know that
+    its metrics files will not change anymore.
+
+    :param pid: the process ID that has exited
+    :param path: the multiprocess directory (defaults to the one in the environment)
+    :param compact: also fold the counter, histogram and summary values
+        of the process into the archive files, see `compact_process_files`
+    """
+
+    if path is None:
+        path = _multiproc_dir()
+
+    with _directory_lock(path, exclusive=True):
+        _mark_process_dead(pid, path, compact)
+
+
+def _mark_process_dead(pid, path, compact):
+    """
+    Mark the process dead, the caller holds the exclusive lock of the directory.
+    """
+
+    while True:
+        try:
+            pc_mark_process_dead(pid, path)
+            break
+        except FileNotFoundError:
+            # removed by a process not holding the lock, look for the rest again
+            continue
+
+    _dead_processes[str(pid)] = time.time()
+
+    if compact:
+        _compact_process_files(pid, path)
+
+
+def _process_exists(pid):
+    if os.name == 'nt':
+        # os.kill() would terminate the process on Windows
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but it belongs to another user
+        return True
+
+    return True
+
+
+def sweep_dead_processes(path=None, compact=True):
+    """
+    Look for the processes with metrics files in the multiprocess directory
+    that don't exist anymore, and mark them dead, for applications that
+    can't (or don't) call `mark_process_dead` when a worker exits.
+
+    Only files named by process IDs are considered, not the ones named by
+    worker slots or worker IDs. The processes have to be visible from
+    this process, for example, they need to be in the same PID namespace.
+
+    :param path: the multiprocess directory (defaults to the one in the environment)
+    :param compact: also compact the files of the dead processes,
+        see `compact_process_files` (defaults to `True`)
+    :return: the list of process IDs marked dead
+    """
+
+    if path is None:
+        path = _multiproc_dir()
+
+    pids = set()
+    for filename in glob.glob(os.path.join(path, '*.db')):
+        pid = os.path.basename(filename)[:-3].split('_')[-1]
+        if pid.isdigit() and pid not in _dead_processes:
+            pids.add(pid)
+
+    dead = sorted(pid for pid in pids if not _process_exists(int(pid)))
+    if dead:
+        with _directory_lock(path, exclusive=True):
+            for pid in dead:
+                # another process may have swept it while waiting for the lock,
+                # then there are no files left to remove or compact
+                _mark_process_dead(pid, path, compact)
+
+    return dead
+
+
+def compact_process_files(pid, path=None):
+    """
+    Fold the counter, histogram and summary values of a process that has exited
+    into the archive files of the multiprocess directory (like `counter_archive.db`),
+    then remove the files of the process, so that the number of files to read
+    on a scrape depends on the number of live processes, not on all
+    the processes that ever existed.
+
+    Gauges are not compacted, since their values depend on their multiprocess mode.
+    Only call this for processes that have exited, the values written
+    by a running process after its files were compacted are lost.
+
+    :param pid: the process ID that has exited
+    :param path: the multiprocess directory (defaults to the one in the environment)
+    """
+
+    if path is None:
+        path = _multiproc_dir()
+
+    with _directory_lock(path, exclusive=True):
+        _compact_process_files(pid, path)
+
+
+def _compact_process_files(pid, path):
+    """
+    Compact the files of the process, the caller holds the exclusive lock of the directory.
+    """
+
+    if not _TIMESTAMPED_FILES:
+        raise RuntimeError('Compacting the metrics files is not supported, ' + _TIMESTAMPED_FILES_REQUIRED)
+
+    for typ in _COMPACTED_TYPES:
+        filename = os.path.join(path, '%s_%s.db' % (typ, pid))
+
+        try:
+            file_values = list(MmapedDict.read_all_values_from_file(filename))
+        except FileNotFoundError:
+            continue
+
+        archive = MmapedDict(os.path.join(path, '%s_%s.db' % (typ, _ARCHIVE_ID)))
+        try:
+            for key, value, timestamp, _ in file_values:
+                archived_value, _ = archive.read_value(key)
+                archive.write_value(key, archived_value + value, timestamp)
+        finally:
+            archive.close()
+
+        os.remove(filename)
+
+
+def _parse_key(key, parsed_keys):
+    """
+    Parse the key of an entry of the metrics files (or of the shared memory
+    and the aggregator, which use the same keys), and cache its parsed form,
+    so that the same series of all the processes share it.
+
+    :param key: the JSON key of the entry, see `mmap_key`
+    :param parsed_keys: the dictionary caching the parsed keys
+    :return: the metric name, sample name, sorted label pairs and help text
+    """
+
+    parsed = parsed_keys.get(key)
+    if parsed is None:
+        metric_name, name, labels, help_text = json.loads(key)
+        parsed = parsed_keys[key] = (metric_name, name, tuple(sorted(labels.items())), help_text)
+
+    return parsed
+
+
+def _add_samples(metrics, typ, mode, pid, samples):
+    """
+    Add the samples of a process to the metrics to accumulate,
+    the same way `MultiProcessCollector` does.
+    """
+
+    for metric_name, name, labels_key, help_text, value, timestamp in samples:
+        metric = metrics.get(metric_name)
+        if metric is None:
+            metric = Metric(metric_name, help_text, typ)
+            metrics[metric_name] = metric
+
+        if typ == 'gauge':
+            metric._multiprocess_mode = mode
+            metric.add_sample(name, labels_key + (('pid', pid),), value, timestamp)
+        else:
+            # the duplicates and labels are fixed when accumulating
+            metric.add_sample(name, labels_key, value)
+
+
+class _MultiProcessFile:
+    """
+    The parsed state of a single multiprocess metrics file.
+    """
+
+    __slots__ = ('typ', 'mode', 'pid', 'identity', 'snapshot', 'data', 'used', 'entries', 'samples')
+
+    def __init__(self, path, stat):
+        parts = os.path.basename(path)[:-3].split('_')
+        self.typ = parts[0]
+        self.mode = parts[1] if self.typ == 'gauge' else None
+        self.pid = parts[-1]
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.snapshot = None
+        self.data = None
+        self.used = 8
+        self.entries = []
+        self.samples = None
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+class IncrementalMultiProcessCollector(MultiProcessCollector):
+    """
+    A collector for the metrics files of multiprocess applications,
+    that produces the same output as `MultiProcessCollector`, but keeps
+    the parsed state of the files between collections.
+
+    The files are kept memory-mapped, and only the entries appended to
+    them since the previous collection are parsed, the values of known
+    entries are read from their known positions.
+    Files of processes marked dead with `mark_process_dead` are read once
+    more, then reused as long as their inode, size and modification time
+    do not change.
+    The files are read while holding a shared lock on the directory,
+    so collections don't overlap with `compact_process_files`.
+
+    With `read_workers` set, the files are read in a thread pool of that size,
+    then merged in the collecting thread. This helps when reading the files
+    waits on the disk, like on a loaded node, parsing them still needs the GIL.
+
+    With `sweep_interval` set, the collection also looks for processes
+    that have exited, at most once in that many seconds,
+    see `sweep_dead_processes`.
+
+    This parses the layout of the metrics files of prometheus-client 0.18.0
+    and later, `MultiProcessCollector` is used instead on earlier versions.
+    """
+
+    def __init__(self, registry, path=None, read_workers=None, sweep_interval=None):
+        if not _TIMESTAMPED_FILES:
+            raise RuntimeError('The incremental collection of the metrics files is not supported, '
+                               + _TIMESTAMPED_FILES_REQUIRED)
+
+        super().__init__(registry, path)
+
+        self._files = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._read_workers = read_workers
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0
+
+        if read_workers:
+            self._executor = ThreadPoolExecutor(
+                max_workers=read_workers, thread_name_prefix='prometheus-multiprocess-reader'
+            )
+        else:
+            self._executor = None
+
+    def collect(self):
+        with self._lock:
+            if self._sweep_interval is not None and default_timer() >= self._next_sweep:
+                # before locking the directory for reading, the compaction locks it exclusively
+                self._next_sweep = default_timer() + self._sweep_interval
+
+                try:
+                    sweep_dead_processes(self._path)
+                except Exception:
+                    # the files are still collected, the next sweep tries again
+                    logger.exception('Failed to sweep the metrics files of the exited processes')
+
+            with _directory_lock(self._path) as locked:
+                metrics = self._collect_files()
+
+            if locked is False and os.path.exists(os.path.join(self._path, _COMPACTION_LOCK_FILE)):
+                # the first compaction started while reading the files without the lock
+                with _directory_lock(self._path):
+                    metrics = self._collect_files()
+
+            return metrics
+
+    def _collect_files(self):
+        """
+        Read the files in the directory and merge their samples,
+        the caller holds the locks.
+        """
+
+        metrics = {}
+        files = {}
+
+        paths = glob.glob(os.path.join(self._path, '*.db'))
+        if self._executor is not None and len(paths) > 1:
+            # one task for each thread, rather than one for each file
+            chunk_size = -(-len(paths) // self._read_workers)
+            chunks = [paths[idx:idx + chunk_size] for idx in range(0, len(paths), chunk_size)]
+            states = itertools.chain.from_iterable(self._executor.map(self._read_files, chunks))
+        else:
+            states = map(self._read_file, paths)
+
+        for path, state in zip(paths, states):
+            if state is None:
+                continue
+
+            files[path] = state
+            _add_samples(metrics, state.typ, state.mode, state.pid, state.samples)
+
+        # release the files that are gone, like the ones of dead processes' live gauges
+        for path, state in self._files.items():
+            if files.get(path) is not state:
+                state.close()
+
+        self._files = files
+
+        return self._accumulate_metrics(metrics, True)
+
+    def _read_files(self, paths):
+        return [self._read_file(path) for path in paths]
+
+    def _read_file(self, path):
+        """
+        Returns the state of a metrics file with its current samples,
+        or `None` if the file is gone or still empty.
+        """
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        state = self._files.get(path)
+        if state is not None and state.identity != (stat.st_dev, stat.st_ino):
+            # the file was replaced, parse it from the start again
+            state.close()
+            state = None
+
+        if state is None:
+            state = _MultiProcessFile(path, stat)
+
+        marked_dead = _dead_processes.get(state.pid)
+        if marked_dead is not None and stat.st_ctime > marked_dead:
+            # the file changed after its process was marked dead,
+            # so the process ID is likely used by a new process
+            _dead_processes.pop(state.pid, None)
+
+        snapshot = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if state.samples is not None and state.data is None and state.snapshot == snapshot:
+            # the process is dead, and its file did not change since
+            return state
+
+        if state.data is None or stat.st_size > len(state.data):
+            if not self._map_file(path, state):
+                return None
+
+        used = _unpack_integer(state.data, 0)[0]
+        if used > len(state.data):
+            # the file has grown since it was checked
+            if not self._map_file(path, state):
+                return None
+
+        data = state.data
+
+        pos = state.used
+        while pos < used:
+            encoded_len = _unpack_integer(data, pos)[0]
+            if encoded_len + pos > used:
+                raise RuntimeError('Read beyond file size detected, file is corrupted.')
+
+            pos += 4
+            key = data[pos:pos + encoded_len].decode('utf-8')
+            pos += encoded_len + (8 - (encoded_len + 4) % 8)
+
+            state.entries.append((_parse_key(key, self._keys), pos))
+            pos += 16
+
+        state.used = pos
+
+        state.samples = [
+            (metric_name, name, labels_key, help_text) + _unpack_two_doubles(data, value_pos)
+            for (metric_name, name, labels_key, help_text), value_pos in state.entries
+        ]
+
+        if state.pid in _dead_processes:
+            # keep the samples, and only check the file for changes from now on
+            state.snapshot = snapshot
+            state.close()
+
+        return state
+
+    @staticmethod
+    def _map_file(path, state):
+        """
+        Memory-map the (possibly grown) file for reading.
+        Returns `False` if the file is gone or still empty.
+        """
+
+        state.close()
+
+        try:
+            with open(path, 'rb') as f:
+                state.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            # the file is empty, it was just created
+            return False
+
+        return True
+
+
+class _SharedMemorySegment:
+    """
+    A fixed-size shared memory segment for the metric values of the workers,
+    created before forking them, and split into a region for each worker slot.
+
+    The regions have the layout of the multiprocess metrics files:
+    the number of bytes used, the process ID owning the slot (or 0 if it's free),
+    then the entries, with their keys prefixed by the type of the metric
+    (and the multiprocess mode of gauges), like `gauge_livesum:`.
+    Only the process owning a slot writes into its region.
+    """
+
+    def __init__(self, slots, slot_size):
+        if slots < 1:
+            raise ValueError('the shared memory segment needs at least one slot')
+        if slot_size < 64 or slot_size % 8:
+            raise ValueError('the slot size must be a multiple of 8 bytes, and at least 64 bytes')
+
+        self.slots = slots
+        self.slot_size = slot_size
+
+        # anonymous memory is shared with the processes forked later
+        self.data = mmap.mmap(-1, slots * slot_size)
+
+        for slot in range(slots):
+            self.data[slot * slot_size:slot * slot_size + 4] = _pack_integer(8)
+
+    def release(self, slot):
+        """
+        Mark the slot of a worker that has exited as free,
+        so that the values of its live gauges are not collected anymore.
+        """
+
+        start = slot * self.slot_size
+        self.data[start + 4:start + 8] = _pack_integer(0)
+
+
+class _SharedMemorySlot:
+    """
+    The region of a worker slot in the shared memory segment,
+    as seen by the process owning it.
+    """
+
+    def __init__(self, segment, slot):
+        if not 0 <= slot < segment.slots:
+            raise ValueError('the worker slot %d is not in the %d slots of the shared memory segment'
+                             % (slot, segment.slots))
+
+        self.data = data = segment.data
+        self._start = slot * segment.slot_size
+        self._end = self._start + segment.slot_size
+        self._used = self._start + _unpack_integer(data, self._start)[0]
+        self._positions = {}
+        self._full = False
+
+        # continue with the values of the previous process in the slot
+        pos = self._start + 8
+        while pos < self._used:
+            encoded_len = _unpack_integer(data, pos)[0]
+            key = data[pos + 4:pos + 4 + encoded_len].decode('utf-8')
+            pos += 4 + encoded_len + (8 - (encoded_len + 4) % 8)
+
+            self._positions[key] = pos
+            if key.startswith('gauge_live'):
+                # the live gauges of the previous process are gone with it
+                data[pos:pos + 16] = _pack_two_doubles(0.0, 0.0)
+
+            pos += 16
+
+        data[self._start + 4:self._start + 8] = _pack_integer(os.getpid())
+
+    def position(self, key):
+        """
+        Returns the position of the value for the key, adding it if needed,
+        or `None` if the key doesn't fit into the slot anymore.
+        """
+
+        pos = self._positions.get(key)
+        if pos is not None:
+            return pos
+
+        encoded = key.encode('utf-8')
+        padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
+        entry = struct.pack('i%dsdd' % len(padded), len(encoded), padded, 0.0, 0.0)
+
+        if self._used + len(entry) > self._end:
+            if not self._full:
+                self._full = True
+
+                import warnings
+                warnings.warn(
+                    'The worker slot of the shared memory segment is full, the values of the new series '
+                    'are kept in process memory and they are not collected, use a larger slot size.',
+                    RuntimeWarning
+                )
+
+            return None
+
+        # write the entry first, then let the collectors see it
+        self.data[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        self.data[self._start:self._start + 4] = _pack_integer(self._used - self._start)
+
+        pos = self._positions[key] = self._used - 16
+        return pos
+
+
+def _shared_memory_value(segment, slot_identifier):
+    """
+    Returns a value class for `prometheus_client`, that keeps the values
+    of the worker processes in their slot of the shared memory segment.
+    Other processes, like the Gunicorn arbiter, and the series that
+    don't fit into the slot anymore keep their values in process memory,
+    and they are not collected.
+
+    :param segment: the shared memory segment
+    :param slot_identifier: the function returning the slot of the current
+        process, or `None` if it's not a worker process
+    """
+
+    created = []
+    current = {'identifier': None, 'slot': None}
+    lock = threading.Lock()
+
+    class SharedMemoryValue:
+        """A float protected by a mutex, backed by a slot of the shared memory segment."""
+
+        _multiprocess = True
+
+        def __init__(self, typ, metric_name, name, labelnames, labelvalues, help_text,
+                     multiprocess_mode='', **kwargs):
+            prefix = typ + '_' + multiprocess_mode if typ == 'gauge' else typ
+
+            self._key = '%s:%s' % (prefix, mmap_key(metric_name, name, labelnames, labelvalues, help_text))
+
+            with lock:
+                self._check_for_slot_change()
+                self._reset()
+                created.append(self)
+
+        def _reset(self):
+            slot = current['slot']
+
+            self._position = None if slot is None else slot.position(self._key)
+
+            if self._position is None:
+                self._value, self._timestamp = 0.0, 0.0
+            else:
+                self._value, self._timestamp = _unpack_two_doubles(slot.data, self._position)
+
+        def _check_for_slot_change(self):
+            identifier = slot_identifier()
+            if current['identifier'] != identifier:
+                # there has been a fork, continue with the values of the slot
+                current['identifier'] = identifier
+                current['slot'] = None if identifier is None else _SharedMemorySlot(segment, identifier)
+
+                for value in created:
+                    value._reset()
+
+        def _write(self):
+            if self._position is not None:
+                segment.data[self._position:self._position + 16] = _pack_two_doubles(self._value, self._timestamp)
+
+        def inc(self, amount):
+            with lock:
+                self._check_for_slot_change()
+                self._value += amount
+                self._timestamp = 0.0
+                self._write()
+
+        def set(self, value, timestamp=None):
+            with lock:
+                self._check_for_slot_change()
+                self._value = value
+                self._timestamp = timestamp or 0.0
+                self._write()
+
+        def set_exemplar(self, exemplar):
+            # not supported in multiprocess mode
+            return
+
+        def get(self):
+            with lock:
+                self._check_for_slot_change()
+                return self._value
+
+        def get_exemplar(self):
+            # not supported in multiprocess mode
+            return None
+
+    return SharedMemoryValue
+
+
+def _use_shared_memory(slots, slot_size, slot_identifier):
+    """
+    Keep the metric values of the worker processes created from now on
+    in a new shared memory segment, instead of in metrics files.
+    """
+
+    global _shared_memory
+
+    _shared_memory = _SharedMemorySegment(slots, slot_size)
+    values.ValueClass = _shared_memory_value(_shared_memory, slot_identifier)
+
+
+class SharedMemoryCollector:
+    """
+    A collector for the metric values of multiprocess applications
+    kept in a shared memory segment, that produces the same output as
+    `MultiProcessCollector` does for the metrics files of the worker slots.
+
+    The segment is read in a single pass over the regions of the slots,
+    and only the entries added since the previous collection are parsed.
+    The live gauges of free slots are not collected.
+    """
+
+    def __init__(self, registry, segment=None):
+        self._segment = segment or _shared_memory
+        if self._segment is None:
+            raise ValueError('the metric values are not kept in shared memory')
+
+        self._parsed = [8] * self._segment.slots
+        self._entries = [{} for _ in range(self._segment.slots)]
+        self._keys = {}
+        self._lock = threading.Lock()
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        with self._lock:
+            metrics = {}
+
+            data = self._segment.data
+            slot_size = self._segment.slot_size
+
+            for slot, entries in enumerate(self._entries):
+                start = slot * slot_size
+                used, owner = _unpack_two_integers(data, start)
+
+                pos = start + self._parsed[slot]
+                while pos < start + used:
+                    encoded_len = _unpack_integer(data, pos)[0]
+                    prefix, key = data[pos + 4:pos + 4 + encoded_len].decode('utf-8').split(':', 1)
+                    pos += 4 + encoded_len + (8 - (encoded_len + 4) % 8)
+
+                    entries.setdefault(prefix, []).append((_parse_key(key, self._keys), pos))
+                    pos += 16
+
+                self._parsed[slot] = pos - start
+
+                for prefix, prefix_entries in entries.items():
+                    typ, _, mode = prefix.partition('_')
+                    if owner == 0 and mode.startswith('live'):
+                        continue
+
+                    samples = [
+                        parsed_key + _unpack_two_doubles(data, value_pos)
+                        for parsed_key, value_pos in prefix_entries
+                    ]
+                    _add_samples(metrics, typ, mode or None, 'slot%d' % slot, samples)
+
+            return MultiProcessCollector._accumulate_metrics(metrics, True)
+
+
+class _AggregatedProcess:
+    """
+    The series of a process, and their values, as received by the aggregator.
+    """
+
+    __slots__ = ('series', 'values')
+
+    def __init__(self):
+        self.series = {}
+        self.values = {}
+
+
+class _MetricsAggregator:
+    """
+    Receives the values of the series that changed in the processes
+    on a Unix datagram socket, and keeps them in memory for the collection.
+
+    The socket is bound when this is created, before forking the workers,
+    then the process calling `start` (like the Gunicorn arbiter) receives
+    the datagrams in a background thread, and serves the metrics.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            self._directory = tempfile.mkdtemp(prefix='prometheus-flask-exporter-')
+            path = os.path.join(self._directory, 'aggregator.sock')
+        else:
+            self._directory = None
+
+        self.path = path
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(path)
+        self._socket.setblocking(False)
+
+        self._processes = {}
+        self._dead_processes = set()
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._owner = None
+
+        atexit.register(self._cleanup)
+
+    def start(self):
+        """
+        Start receiving the values in this process, unless it's done
+        in this or another process already.
+        """
+
+        with self._lock:
+            if self._owner is not None:
+                return
+
+            self._owner = os.getpid()
+
+        thread = threading.Thread(target=self._run, name='prometheus-aggregator', daemon=True)
+        thread.start()
+
+    def in_this_process(self):
+        """
+        Whether this is the process that created the aggregator
+        or receives the values, which doesn't send values itself.
+        """
+
+        return os.getpid() in (self._pid, self._owner)
+
+    def _run(self):
+        while True:
+            select.select([self._socket], [], [])
+
+            with self._lock:
+                self._receive()
+
+    def _receive(self):
+        """
+        Handle the datagrams waiting on the socket, the caller holds the lock.
+        """
+
+        while True:
+            try:
+                datagram = self._socket.recv(_AGGREGATOR_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+
+            try:
+                self._handle(datagram)
+            except (struct.error, UnicodeDecodeError, ValueError):
+                # not sent by a process of this application
+                continue
+
+    def _handle(self, datagram):
+        pid, flags = _AGGREGATOR_HEADER.unpack_from(datagram, 0)
+
+        if flags & _AGGREGATOR_NEW_PROCESS:
+            self._new_process(pid)
+        elif pid in self._dead_processes:
+            # sent before the process exited, its values are archived already
+            return
+
+        state = self._processes.get(pid)
+        if state is None:
+            state = self._processes[pid] = _AggregatedProcess()
+
+        pos = _AGGREGATOR_HEADER.size
+        while pos < len(datagram):
+            series_id, value, timestamp, key_length = _AGGREGATOR_RECORD.unpack_from(datagram, pos)
+            pos += _AGGREGATOR_RECORD.size
+
+            if key_length:
+                prefix, key = datagram[pos:pos + key_length].decode('utf-8').split(':', 1)
+                state.series[series_id] = (prefix, _parse_key(key, self._keys))
+                pos += key_length
+
+            if series_id not in state.series:
+                continue
+
+            state.values[series_id] = (value, timestamp)
+
+    def _new_process(self, pid):
+        """
+        Start over for a process ID reused by a new process, keeping the values
+        of the previous process that can be summed up across processes.
+        """
+
+        self._dead_processes.discard(pid)
+
+        previous = self._processes.pop(pid, None)
+        if previous is not None:
+            self._archive(previous)
+
+    def _archive(self, state):
+        """
+        Fold the counter, histogram and summary values of a process
+        into the archive entry, and drop the other values.
+        """
+
+        archive = self._processes.get(_ARCHIVE_ID)
+        if archive is None:
+            archive = self._processes[_ARCHIVE_ID] = _AggregatedProcess()
+
+        for series_id, (value, _) in state.values.items():
+            series = state.series[series_id]
+            if series[0] in _COMPACTED_TYPES:
+                archive.series[series] = series
+                archive.values[series] = (archive.values.get(series, (0.0, 0.0))[0] + value, 0.0)
+
+    def mark_process_dead(self, pid):
+        """
+        Fold the counter, histogram and summary values of a process
+        that has exited into the archive entry, then forget the process,
+        so that the scrapes don't get slower with every process that
+        has ever existed. Its gauge values are dropped.
+        """
+
+        with self._lock:
+            self._receive()
+
+            pid = int(pid)
+            self._dead_processes.add(pid)
+
+            state = self._processes.pop(pid, None)
+            if state is not None:
+                self._archive(state)
+
+    def collect(self):
+        if self._owner != os.getpid():
+            raise RuntimeError('the metrics are aggregated in another process, '
+                               'serve them from the process that started the aggregator')
+
+        with self._lock:
+            self._receive()
+
+            metrics = {}
+
+            for pid, state in self._processes.items():
+                samples = {}
+                for series_id, value in state.values.items():
+                    prefix, parsed_key = state.series[series_id]
+                    samples.setdefault(prefix, []).append(parsed_key + value)
+
+                for prefix, prefix_samples in samples.items():
+                    typ, _, mode = prefix.partition('_')
+                    _add_samples(metrics, typ, mode or None, str(pid), prefix_samples)
+
+            return MultiProcessCollector._accumulate_metrics(metrics, True)
+
+    def _cleanup(self):
+        if self._owner != os.getpid():
+            return
+
+        self._socket.close()
+
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _aggregated_value(address, flush_interval, process_identifier=os.getpid, aggregator=None):
+    """
+    Returns a value class for `prometheus_client`, that keeps the values
+    in process memory, and sends the ones that changed to the aggregator
+    from a background thread, every `flush_interval` seconds.
+
+    :param address: the path of the socket of the aggregator
+    :param flush_interval: the number of seconds between sending the changes
+    :param process_identifier: the function returning the ID of the current process
+    :param aggregator: the aggregator, if it was created in this process,
+        nothing is sent from the processes where `in_this_process` is `True`
+    """
+
+    created = []
+    changed = {}
+    sent = set()
+    oversized = set()
+    series_ids = itertools.count(1)
+    current = {'pid': None, 'announced': False, 'socket': None}
+    lock = threading.Lock()
+    flush_lock = threading.Lock()
+
+    def check_for_pid_change():
+        # the lock is held by the caller
+        pid = process_identifier()
+        if current['pid'] != pid:
+            # there has been a fork, start over with the values of a new process
+            if current['socket'] is not None:
+                current['socket'].close()
+
+            current.update(pid=pid, announced=False, socket=None)
+            sent.clear()
+            changed.clear()
+
+            for value in created:
+                value._value, value._timestamp = 0.0, 0.0
+                changed[value._id] = value
+
+            if not sends_values():
+                return
+
+            flusher = threading.Thread(target=flush_periodically, name='prometheus-aggregator-flush', daemon=True)
+            flusher.start()
+
+    def sends_values():
+        # the process receiving the values (like the Gunicorn arbiter with
+        # `preload_app`) would only fill up the queue of the socket before it
+        # starts receiving, and the workers would inherit the locks held
+        return aggregator is None or not aggregator.in_this_process()
+
+    def reset_after_fork():
+        nonlocal lock, flush_lock
+
+        # the locks may have been held by a thread of the parent process,
+        # which doesn't exist in the child, and neither does its flusher thread
+        lock = threading.Lock()
+        flush_lock = threading.Lock()
+
+        if current['socket'] is not None:
+            current['socket'].close()
+
+        # the values start over on the next change, see `check_for_pid_change`
+        current.update(pid=None, announced=False, socket=None)
+
+    def flush_periodically():
+        pid = current['pid']
+
+        while current['pid'] == pid:
+            time.sleep(flush_interval)
+            flush()
+
+    def flush():
+        """
+        Send the values that changed since the previous call to the aggregator.
+        """
+
+        if not sends_values():
+            return
+
+        with flush_lock:
+            with lock:
+                pid = current['pid']
+                if pid is None:
+                    return
+
+                batch = list(changed.values())
+                changed.clear()
+
+                records = []
+                for value in batch:
+                    if value._id in oversized:
+                        continue
+
+                    key = b'' if value._id in sent else value._key
+                    record = _AGGREGATOR_RECORD.pack(value._id, value._value, value._timestamp, len(key)) + key
+
+                    if _AGGREGATOR_HEADER.size + len(record) > _AGGREGATOR_DATAGRAM_SIZE:
+                        # it would never fit into a datagram, and the key can't be split
+                        oversized.add(value._id)
+                        logger.warning('The series %s does not fit into a datagram of %d bytes, '
+                                       'its values are not sent to the aggregator',
+                                       value._key[:200].decode('utf-8', 'replace'), _AGGREGATOR_DATAGRAM_SIZE)
+                        continue
+
+                    records.append(record)
+
+            try:
+                if current['socket'] is None:
+                    current['socket'] = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    # waits for the aggregator when its queue is full, but not forever
+                    current['socket'].settimeout(1.0)
+
+                if not current['announced']:
+                    current['socket'].sendto(_AGGREGATOR_HEADER.pack(pid, _AGGREGATOR_NEW_PROCESS), address)
+                    current['announced'] = True
+
+                header = _AGGREGATOR_HEADER.pack(pid, 0)
+                datagram = header
+                for record in records:
+                    if len(datagram) + len(record) > _AGGREGATOR_DATAGRAM_SIZE and len(datagram) > len(header):
+                        current['socket'].sendto(datagram, address)
+                        datagram = header
+
+                    datagram += record
+
+                if len(datagram) > len(header):
+                    current['socket'].sendto(datagram, address)
+
+            except OSError:
+                # the aggregator is not there (yet), send these again next time
+                with lock:
+                    if current['pid'] == pid:
+                        for value in batch:
+                            changed.setdefault(value._id, value)
+
+                return
+
+            with lock:
+                if current['pid'] == pid:
+                    sent.update(value._id for value in batch)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=reset_after_fork)
+
+    # send the values changed right before a worker exits
+    atexit.register(flush)
+
+    class AggregatedValue:
+        """A float protected by a mutex, sent to the aggregator when it changes."""
+
+        _multiprocess = True
+
+        def __init__(self, typ, metric_name, name, labelnames, labelvalues, help_text,
+                     multiprocess_mode='', **kwargs):
+            prefix = typ + '_' + multiprocess_mode if typ == 'gauge' else typ
+
+            self._key = ('%s:%s' % (prefix, mmap_key(metric_name, name, labelnames, labelvalues, help_text))).encode('utf-8')
+            self._value, self._timestamp = 0.0, 0.0
+
+            with lock:
+                self._id = next(series_ids)
+                created.append(self)
+                check_for_pid_change()
+                changed[self._id] = self
+
+        def inc(self, amount):
+            with lock:
+                check_for_pid_change()
+                self._value += amount
+                self._timestamp = 0.0
+                changed[self._id] = self
+
+        def set(self, value, timestamp=None):
+            with lock:
+                check_for_pid_change()
+                self._value = value
+                self._timestamp = timestamp or 0.0
+                changed[self._id] = self
+
+        def set_exemplar(self, exemplar):
+            # not supported in multiprocess mode
+            return
+
+        def get(self):
+            with lock:
+                check_for_pid_change()
+                return self._value
+
+        def get_exemplar(self):
+            # not supported in multiprocess mode
+            return None
+
+        @classmethod
+        def flush(cls):
+            flush()
+
+    return AggregatedValue
+
+
+def _use_aggregator(socket_path, flush_interval):
+    """
+    Send the metric values of the processes created from now on
+    to a new aggregator, instead of writing them into metrics files.
+    """
+
+    global _aggregator
+
+    _aggregator = _MetricsAggregator(socket_path)
+    values.ValueClass = _aggregated_value(_aggregator.path, flush_interval, aggregator=_aggregator)
+
+
+class AggregatorCollector:
+    """
+    A collector for the metric values of multiprocess applications
+    sent to the aggregator, that produces the same output as
+    `MultiProcessCollector` does for the metrics files of the processes.
+
+    Collect the metrics in the process that started the aggregator only.
+    """
+
+    def __init__(self, registry, aggregator=None):
+        self._aggregator = aggregator or _aggregator
+        if self._aggregator is None:
+            raise ValueError('the metric values are not sent to an aggregator')
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        return self._aggregator.collect()
+
+
+def _create_collector(registry, path=None, read_workers=None, sweep_interval=None):
+    """
+    Create the collector merging the metrics of all processes,
+    from the aggregator if the values are sent there, from the shared memory
+    segment if the values are kept there, or from the metrics files otherwise.
+    """
+
+    if _aggregator is not None:
+        return AggregatorCollector(registry, _aggregator)
+
+    if _shared_memory is not None:
+        return SharedMemoryCollector(registry, _shared_memory)
+
+    if not _TIMESTAMPED_FILES:
+        # the files can't be parsed incrementally, see `IncrementalMultiProcessCollector`
+        return MultiProcessCollector(registry, path)
+
+    return IncrementalMultiProcessCollector(
+        registry, path, read_workers=read_workers, sweep_interval=sweep_interval
+    )
+
+
 class MultiprocessPrometheusMetrics(PrometheusMetrics):
     """
     An extension of the `PrometheusMetrics` class that provides
@@ -44,18 +1587,28 @@ class MultiprocessPrometheusMetrics(PrometheusMetrics):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, app=None, **kwargs):
+    def __init__(self, app=None, read_workers=None, sweep_interval=None, **kwargs):
         """
         Create a new multiprocess-aware Prometheus metrics export configuration.
 
         :param registry: the Prometheus Registry to use (can be `None` and it
-            will be registered with `prometheus_client.multiprocess.MultiProcessCollector`)
+            will be registered with `IncrementalMultiProcessCollector`,
+            or with `SharedMemoryCollector` if the values are kept in shared memory)
+        :param read_workers: the number of threads to read the metrics files
+            of the processes with in parallel on a scrape
+            (defaults to `None` to read them in the scraping thread)
+        :param sweep_interval: look for processes that have exited on scrapes,
+            at most once in this many seconds, then mark them dead and compact
+            their files, without a `child_exit` hook
+            (defaults to `None` to disable it)
         """
 
         _check_multiproc_env_var()
 
+        collector_options = {'read_workers': read_workers, 'sweep_interval': sweep_interval}
+
         registry = kwargs.pop('registry', CollectorRegistry())
-        MultiProcessCollector(registry)
+        _create_collector(registry, **collector_options)
 
         kwargs.pop('path', None)  # remove the path parameter if it was passed in
 
@@ -63,6 +1616,26 @@ class MultiprocessPrometheusMetrics(PrometheusMetrics):
             app=app, path=None, registry=registry, **kwargs
         )
 
+        # the values may be in shared memory, without a multiprocess directory
+        self._multiprocess = True
+        self._multiprocess_options = collector_options
+
+    def init_app(self, app):
+        """
+        Initialize the application, see `PrometheusMetrics.init_app`.
+        With batched writes, the metrics changed while handling a request
+        are written into the metrics files at once, at the end of the request.
+
+        :param app: the Flask application
+        """
+
+        super().init_app(app)
+
+        value_class = values.ValueClass
+        if hasattr(value_class, 'start_batch'):
+            # wraps the middleware of the default metrics in `wsgi` mode as well
+            app.wsgi_app = _batched_writes_middleware(app.wsgi_app, value_class)
+
     def start_http_server(self, port, host='0.0.0.0', endpoint=None, ssl=None):
         """
         Start an HTTP server for exposing the metrics, if the
@@ -76,8 +1649,49 @@ class MultiprocessPrometheusMetrics(PrometheusMetrics):
         """
 
         if self.should_start_http_server():
+            if _aggregator is not None:
+                # the metrics are served from the process receiving them
+                _aggregator.start()
+
             pc_start_http_server(port, host, registry=self.registry)
 
+    @classmethod
+    def use_batched_writes(cls):
+        """
+        Write the counter, histogram and summary values changed while handling
+        a request into the metrics files in a single batch, at the end of the request,
+        instead of writing each change immediately, holding the lock each time.
+        Changes made outside of requests, and the values of gauges,
+        are written immediately.
+
+        Call this before any metrics are created, for example at the top
+        of the module creating the Flask app, or the Gunicorn config module.
+        """
+
+        _use_batched_writes()
+
+    @classmethod
+    def use_aggregator(cls, socket_path=None, flush_interval=0.1):
+        """
+        Send the metric values of the processes to an aggregator
+        over a Unix datagram socket, instead of writing them into metrics files.
+        The processes keep their values in memory, and send the ones that changed
+        every `flush_interval` seconds from a background thread, then the process
+        serving the metrics with `start_http_server` receives and merges them.
+        The multiprocess directory is not needed in this case.
+
+        Call this in the main process (like the Gunicorn arbiter or the uWSGI master),
+        before any metrics are created and before the workers are forked,
+        for example at the top of the Gunicorn config module.
+
+        :param socket_path: the path of the socket to bind
+            (defaults to one in a new temporary directory)
+        :param flush_interval: the number of seconds between sending the changes
+            from each process (defaults to 0.1)
+        """
+
+        _use_aggregator(socket_path, flush_interval)
+
     @abstractmethod
     def should_start_http_server(self):
         """
@@ -118,7 +1732,7 @@ class MultiprocessInternalPrometheusMetrics(MultiprocessPrometheusMetrics):
         return False
 
     @classmethod
-    def start_http_server_when_ready(cls, port, host='0.0.0.0'):
+    def start_http_server_when_ready(cls, port, host='0.0.0.0', **kwargs):
         import warnings
         warnings.warn(
             'The `MultiprocessInternalPrometheusMetrics` class is expected to expose the metrics endpoint '
@@ -138,6 +1752,39 @@ class UWsgiPrometheusMetrics(MultiprocessPrometheusMetrics):
         import uwsgi
         return os.getpid() == uwsgi.masterpid()
 
+    @classmethod
+    def use_worker_ids(cls):
+        """
+        Name the metrics files of the workers by their uWSGI worker ID,
+        instead of by their process ID, so that a respawned worker keeps
+        accumulating into the files of the worker it replaces, and the number
+        of files stays bounded by the number of workers.
+
+        Call this before any metrics are created, for example at the top
+        of the module creating the Flask app.
+        """
+
+        _use_process_identifier(_uwsgi_process_identifier)
+
+    @classmethod
+    def use_shared_memory(cls, slots, slot_size=_DEFAULT_SHARED_MEMORY_SLOT_SIZE):
+        """
+        Keep the metric values of the workers in a single shared memory segment,
+        with a fixed-size region for each uWSGI worker ID, instead of in metrics files.
+        The multiprocess directory is not needed, and scrapes read the one segment
+        instead of all the files in it.
+
+        Call this in the master process, before any metrics are created
+        and before the workers are forked, for example at the top of the module
+        creating the Flask app (without `lazy-apps`).
+
+        :param slots: the number of slots, at least the number of workers
+        :param slot_size: the size of the region of each slot in bytes
+            (defaults to 1 MiB)
+        """
+
+        _use_shared_memory(slots, slot_size, _uwsgi_worker_slot)
+
 
 class GunicornPrometheusMetrics(MultiprocessPrometheusMetrics):
     """
@@ -163,7 +1810,86 @@ class GunicornPrometheusMetrics(MultiprocessPrometheusMetrics):
         return True
 
     @classmethod
-    def start_http_server_when_ready(cls, port, host='0.0.0.0'):
+    def use_worker_slots(cls):
+        """
+        Name the metrics files of the workers by a worker slot allocated
+        by the arbiter, instead of by their process ID, so that a replacement
+        worker keeps accumulating into the files of the worker it replaces,
+        and the number of files stays bounded by the number of workers.
+
+        Call this at the top of the Gunicorn config module, and allocate
+        the slots with `allocate_worker_slot_on_pre_fork`.
+
+        Example:
+
+            GunicornPrometheusMetrics.use_worker_slots()
+
+            def pre_fork(server, worker):
+                GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, worker)
+        """
+
+        _use_process_identifier(_gunicorn_process_identifier)
+
+    @classmethod
+    def use_shared_memory(cls, slots, slot_size=_DEFAULT_SHARED_MEMORY_SLOT_SIZE):
+        """
+        Keep the metric values of the workers in a single shared memory segment,
+        with a fixed-size region for each worker slot, instead of in metrics files.
+        The multiprocess directory is not needed, and scrapes read the one segment
+        instead of all the files in it.
+
+        Call this at the top of the Gunicorn config module, before any metrics
+        are created, and allocate the slots with `allocate_worker_slot_on_pre_fork`.
+
+        Example:
+
+            GunicornPrometheusMetrics.use_shared_memory(slots=8)
+
+            def pre_fork(server, worker):
+                GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, worker)
+
+            def child_exit(server, worker):
+                GunicornPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
+
+        :param slots: the number of slots, at least the number of workers
+            running at the same time, including the ones started on reloads
+        :param slot_size: the size of the region of each slot in bytes
+            (defaults to 1 MiB)
+        """
+
+        _use_shared_memory(slots, slot_size, _gunicorn_worker_slot)
+
+    @classmethod
+    def allocate_worker_slot_on_pre_fork(cls, server, worker):
+        """
+        Allocate the lowest worker slot not used by a running worker
+        for the worker about to be forked, from the Gunicorn config module.
+
+        :param server: the Gunicorn arbiter
+        :param worker: the Gunicorn worker about to be forked
+        """
+
+        global _gunicorn_forked_slot
+
+        running = {id(running_worker) for running_worker in server.WORKERS.values()}
+        used = {slot for slot, slot_worker in _gunicorn_slots.items() if id(slot_worker) in running}
+
+        slot = 0
+        while slot in used:
+            slot += 1
+
+        if _shared_memory is not None and slot >= _shared_memory.slots:
+            raise ValueError('no free worker slot in the shared memory segment, '
+                             'all of its %d slots are used' % _shared_memory.slots)
+
+        _gunicorn_slots[slot] = worker
+        _gunicorn_forked_slot = (os.getpid(), slot)
+
+        # the files of the slot are going to change again
+        _dead_processes.pop('slot%d' % slot, None)
+
+    @classmethod
+    def start_http_server_when_ready(cls, port, host='0.0.0.0', **kwargs):
         """
         Start the HTTP server from the Gunicorn config module.
         Doesn't necessarily need an instance, a class is fine.
@@ -175,14 +1901,16 @@ class GunicornPrometheusMetrics(MultiprocessPrometheusMetrics):
 
         :param port: the HTTP port to expose the metrics endpoint on
         :param host: the HTTP host to listen on (default: `0.0.0.0`)
+        :param kwargs: the arguments of the `GunicornPrometheusMetrics`
+            instance serving the metrics, like `read_workers` or `sweep_interval`
         """
 
         _check_multiproc_env_var()
 
-        GunicornPrometheusMetrics().start_http_server(port, host)
+        GunicornPrometheusMetrics(**kwargs).start_http_server(port, host)
 
     @classmethod
-    def mark_process_dead_on_child_exit(cls, pid):
+    def mark_process_dead_on_child_exit(cls, pid, compact=False):
         """
         Mark a child worker as exited from the Gunicorn config module.
 
@@ -192,9 +1920,31 @@ class GunicornPrometheusMetrics(MultiprocessPrometheusMetrics):
                 GunicornPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
 
         :param pid: the worker pid that has exited
+        :param compact: also fold the counter, histogram and summary values
+            of the worker into the archive files, and remove its files
+            (defaults to `False`, not used with shared memory or the aggregator)
         """
 
-        pc_mark_process_dead(pid)
+        slot = next((slot for slot, worker in _gunicorn_slots.items() if worker.pid == pid), None)
+        if slot is not None:
+            # the process ID may be reused by a worker in another slot later
+            del _gunicorn_slots[slot]
+
+        if _aggregator is not None:
+            _aggregator.mark_process_dead(pid)
+            return
+
+        if _shared_memory is not None:
+            if slot is not None:
+                _shared_memory.release(slot)
+
+            return
+
+        if slot is not None:
+            # the files of the worker are named by its slot
+            pid = 'slot%d' % slot
+
+        mark_process_dead(pid, compact=compact)
 
 
 class GunicornInternalPrometheusMetrics(GunicornPrometheusMetrics):
@@ -231,7 +1981,7 @@ class GunicornInternalPrometheusMetrics(GunicornPrometheusMetrics):
         return False
 
     @classmethod
-    def start_http_server_when_ready(cls, port, host='0.0.0.0'):
+    def start_http_server_when_ready(cls, port, host='0.0.0.0', **kwargs):
         import warnings
         warnings.warn(
             'The `GunicornInternalPrometheusMetrics` class is expected to expose the metrics endpoint '
@@ -30,4 +30,5 @@ setup(
         'Programming Language :: Python :: 3.12',
     ],
     install_requires=['prometheus_client', 'flask'],
+    extras_require={'zstd': ['zstandard']},
 )
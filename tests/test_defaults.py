@@ -113,6 +113,40 @@ class DefaultsTest(BaseTestCase):
             ('method', 'GET'), ('path', '/skip'), ('status', 200)
         )
 
+    def test_exception_response_for_default_labels(self):
+        self.metrics(default_labels={'code': lambda r: r.status_code})
+
+        @self.app.route('/error')
+        def test_error():
+            raise AttributeError
+
+        with self.assertRaises(AttributeError):
+            self.client.get('/error')
+
+        self.assertMetric(
+            'flask_http_request_exceptions_total', '1.0',
+            ('method', 'GET'), ('status', 500), ('code', 500)
+        )
+
+    def test_no_exception_response_without_response_labels(self):
+        from unittest.mock import patch
+
+        self.metrics(default_labels={'static': 'value'})
+
+        @self.app.route('/error')
+        def test_error():
+            raise AttributeError
+
+        with patch('prometheus_flask_exporter.make_response') as make_response:
+            with self.assertRaises(AttributeError):
+                self.client.get('/error')
+
+        make_response.assert_not_called()
+        self.assertMetric(
+            'flask_http_request_exceptions_total', '1.0',
+            ('method', 'GET'), ('status', 500), ('static', 'value')
+        )
+
     def test_exception_counter_metric(self):
         self.metrics()
 
@@ -795,3 +829,219 @@ class DefaultsTest(BaseTestCase):
             'flask_exporter_info', '',
             ('version', metrics.version)  # no default labels here
         )
+
+    def test_default_labels_resolved_once_per_request(self):
+        class Invocations:
+            value = 0
+
+        def tenant():
+            Invocations.value += 1
+            return 'tenant-%s' % request.args.get('t', 'none')
+
+        metrics = self.metrics(default_labels={'tenant': tenant})
+
+        @self.app.route('/test')
+        @metrics.counter('test_counter', 'Test Counter')
+        @metrics.histogram('test_histogram', 'Test Histogram',
+                           labels={'code': lambda r: r.status_code})
+        def test():
+            return 'OK'
+
+        self.client.get('/test?t=a')
+        self.assertEqual(Invocations.value, 1)
+
+        self.client.get('/test?t=b')
+        self.assertEqual(Invocations.value, 2)
+
+        self.assertMetric(
+            'flask_http_request_total', '1.0',
+            ('method', 'GET'), ('status', 200), ('tenant', 'tenant-a')
+        )
+        self.assertMetric(
+            'test_counter_total', '1.0',
+            ('tenant', 'tenant-b')
+        )
+        self.assertMetric(
+            'test_histogram_count', '1.0',
+            ('code', 200), ('tenant', 'tenant-b')
+        )
+
+    def test_cached_default_children(self):
+        from unittest.mock import patch
+        from prometheus_client.metrics import MetricWrapperBase
+
+        self.metrics(group_by='url_rule', default_cache_children=True)
+
+        @self.app.route('/test/<item>')
+        def test(item):
+            return 'OK'
+
+        with patch.object(MetricWrapperBase, 'labels', autospec=True,
+                          side_effect=MetricWrapperBase.labels) as labels:
+            for item in ('a', 'b', 'c', 'a', 'b'):
+                self.client.get('/test/%s' % item)
+
+            # one lookup for the duration and one for the total metric
+            self.assertEqual(labels.call_count, 2)
+
+        self.assertMetric(
+            'flask_http_request_total', '5.0',
+            ('method', 'GET'), ('status', 200)
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_count', '5.0',
+            ('method', 'GET'), ('url_rule', '/test/<item>'), ('status', 200)
+        )
+
+    def test_sharded_metrics(self):
+        import threading
+        from prometheus_client import Counter, Histogram
+
+        metrics = self.metrics(sharded_metrics=True)
+
+        @self.app.route('/test')
+        @metrics.counter('cnt_sharded', 'Counter')
+        @metrics.histogram('hist_sharded', 'Histogram', labels={'path': lambda: request.path})
+        def test():
+            return 'OK'
+
+        def send_requests():
+            client = self.app.test_client()
+            for _ in range(50):
+                client.get('/test')
+
+        threads = [threading.Thread(target=send_requests) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the shards of the exited threads are folded in, the next requests continue counting
+        self.assertMetric('cnt_sharded_total', '200.0')
+        send_requests()
+
+        self.assertMetric('cnt_sharded_total', '250.0')
+        self.assertMetric('hist_sharded_count', '250.0', ('path', '/test'))
+        self.assertMetric('hist_sharded_bucket', '250.0', ('path', '/test'), ('le', '+Inf'))
+        self.assertMetric(
+            'flask_http_request_total', '250.0',
+            ('method', 'GET'), ('status', 200)
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_count', '250.0',
+            ('method', 'GET'), ('path', '/test'), ('status', 200)
+        )
+
+        for metric in metrics.registry._collector_to_names:
+            if isinstance(metric, (Counter, Histogram)):
+                self.assertTrue(type(metric).__name__.startswith('_Sharded'), metric)
+
+    def test_sharded_metrics_labels(self):
+        from prometheus_flask_exporter import _ShardedCounter
+
+        counter = _ShardedCounter('cnt_sharded_labels', 'Counter', ('method', 'status'), registry=None)
+        child = counter.labels('GET', 200)
+
+        # existing children are found with positional and keyword label values
+        self.assertIs(counter.labels('GET', '200'), child)
+        self.assertIs(counter.labels(status=200, method='GET'), child)
+
+        # incorrect label values are still rejected
+        self.assertRaises(ValueError, counter.labels, 'GET')
+        self.assertRaises(ValueError, counter.labels, method='GET', code=200)
+        self.assertRaises(ValueError, child.labels, 'GET', 200)
+
+    def test_sharded_metrics_share_thread_local(self):
+        from prometheus_flask_exporter import _ShardedHistogram
+
+        histogram = _ShardedHistogram('hist_sharded_local', 'Histogram', ('path',), registry=None)
+        first, second = histogram.labels('/first'), histogram.labels('/second')
+
+        # the values of a child share one thread-local, the children don't
+        self.assertTrue(all(bucket._local is first._sum._local for bucket in first._buckets))
+        self.assertIsNot(first._sum._local, second._sum._local)
+
+        first.observe(0.25)
+        first.observe(0.75)
+        second.observe(3.0)
+
+        self.assertEqual(first._sum.get(), 1.0)
+        self.assertEqual(sum(bucket.get() for bucket in first._buckets), 2.0)
+        self.assertEqual(second._sum.get(), 3.0)
+
+    def test_wsgi_mode(self):
+        import time
+        from flask import Response
+
+        metrics = self.metrics(mode='wsgi', default_labels={'dm': lambda: request.method})
+
+        @self.app.route('/test')
+        def test():
+            return 'OK'
+
+        @self.app.route('/stream')
+        def stream():
+            def generate():
+                yield 'first'
+                time.sleep(0.2)
+                yield 'second'
+
+            return Response(generate())
+
+        @self.app.route('/skip')
+        @metrics.do_not_track()
+        def skip():
+            return 'OK'
+
+        @self.app.route('/error')
+        def error():
+            raise ValueError('testing')
+
+        for path in ('/test', '/test', '/stream', '/skip'):
+            with self.client.get(path) as response:
+                self.assertEqual(response.status_code, 200)
+                self.assertIsNotNone(response.data)
+
+        with self.assertRaises(ValueError):
+            self.client.get('/error')
+
+        self.assertMetric(
+            'flask_http_request_total', '3.0',
+            ('method', 'GET'), ('status', 200), ('dm', 'GET')
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_count', '2.0',
+            ('method', 'GET'), ('path', '/test'), ('status', 200), ('dm', 'GET')
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_bucket', '0.0',
+            ('le', '0.1'), ('method', 'GET'), ('path', '/stream'), ('status', 200), ('dm', 'GET')
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_bucket', '1.0',
+            ('le', '0.25'), ('method', 'GET'), ('path', '/stream'), ('status', 200), ('dm', 'GET')
+        )
+        self.assertMetric(
+            'flask_http_request_exceptions_total', '1.0',
+            ('method', 'GET'), ('status', 500), ('dm', 'GET')
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_count', '1.0',
+            ('method', 'GET'), ('path', '/error'), ('status', 500), ('dm', 'GET')
+        )
+        self.assertAbsent(
+            'flask_http_request_duration_seconds_count',
+            ('method', 'GET'), ('path', '/skip'), ('status', 200), ('dm', 'GET')
+        )
+        self.assertAbsent(
+            'flask_http_request_duration_seconds_count',
+            ('method', 'GET'), ('path', '/metrics'), ('status', 200), ('dm', 'GET')
+        )
+
+    def test_wsgi_mode_with_response_labels(self):
+        self.assertRaises(
+            ValueError, self.metrics,
+            mode='wsgi', default_labels={'code': lambda r: r.status_code}
+        )
+
+        self.assertRaises(ValueError, self.metrics, mode='unknown')
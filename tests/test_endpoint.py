@@ -1,4 +1,10 @@
+import functools
+import gzip
+import os
+import tempfile
+import threading
 import time
+from unittest.mock import patch
 
 import werkzeug.exceptions
 from flask import request, abort
@@ -80,6 +86,165 @@ class EndpointTest(BaseTestCase):
         self.assertIn('flask_http_request_duration_seconds_count', response_data)
         self.assertIn('flask_http_request_duration_seconds_sum', response_data)
 
+    def test_cached_metrics(self):
+        metrics = self.metrics(metrics_cache_ttl=60)
+
+        class SlowCollector:
+            collections = 0
+
+            def collect(self):
+                SlowCollector.collections += 1
+                time.sleep(0.2)
+                return []
+
+        metrics.registry.register(SlowCollector())
+
+        counter = metrics.info('cached_info', 'Info for caching')
+        self.assertMetric('cached_info', '1.0')
+
+        counter.set(5)
+        self.assertMetric('cached_info', '1.0')
+
+        response_data, _ = metrics.generate_metrics(names=['cached_info'])
+        self.assertIn('cached_info 5.0', response_data)
+
+        threads = [
+            threading.Thread(target=metrics.generate_metrics, args=('application/openmetrics-text',))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # once for each format, and once for the name filter
+        self.assertEqual(SlowCollector.collections, 3)
+
+    def test_compressed_metrics(self):
+        metrics = self.metrics(compress_metrics=True, metrics_cache_ttl=60)
+        metrics.info('compressed_info', 'Info for compression')
+
+        response = self.client.get('/metrics', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertIn(b'compressed_info 1.0', gzip.decompress(response.data))
+
+        # the compressed output is cached too
+        self.assertEqual(
+            response.data,
+            self.client.get('/metrics', headers={'Accept-Encoding': 'gzip'}).data
+        )
+
+        response = self.client.get('/metrics', headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'compressed_info 1.0', response.data)
+
+        response = self.client.get('/metrics', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_compressed_metrics_expire_with_the_cached_output(self):
+        metrics = self.metrics(compress_metrics=True, metrics_cache_ttl=1)
+        info = metrics.info('compressed_info', 'Info for compression')
+
+        def scrape(now, encoding):
+            with patch('prometheus_flask_exporter.default_timer', return_value=now):
+                response = self.client.get('/metrics', headers={'Accept-Encoding': encoding})
+
+            if encoding == 'gzip':
+                return gzip.decompress(response.data)
+            return response.data
+
+        self.assertIn(b'compressed_info 1.0', scrape(100.0, 'identity'))
+        info.set(2)
+
+        # compressed from the cached output, that is almost expired
+        self.assertIn(b'compressed_info 1.0', scrape(100.9, 'gzip'))
+        self.assertIn(b'compressed_info 2.0', scrape(101.5, 'gzip'))
+        self.assertIn(b'compressed_info 2.0', scrape(101.5, 'identity'))
+
+    def test_streamed_metrics(self):
+        metrics = self.metrics(stream_metrics=True, compress_metrics=True)
+        metrics.info('streamed_info', 'Info for streaming')
+
+        @self.app.route('/test')
+        def test():
+            return 'OK'
+
+        self.client.get('/test')
+
+        for accept in ('text/plain', 'application/openmetrics-text'):
+            expected, _ = metrics.generate_metrics(accept)
+
+            response = self.client.get('/metrics', headers={'Accept': accept})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.get_data(as_text=True), expected)
+
+            response = self.client.get('/metrics', headers={'Accept': accept, 'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.get_data()).decode('utf-8'), expected)
+
+        response = self.client.get('/metrics?name[]=streamed_info')
+        self.assertEqual(response.get_data(as_text=True), metrics.generate_metrics(names=['streamed_info'])[0])
+
+    def test_cached_rendered_families(self):
+        import prometheus_flask_exporter
+        from prometheus_client import Counter, generate_latest
+
+        metrics = self.metrics(export_defaults=False, cache_rendered_families=True)
+
+        first = Counter('first', 'First counter', registry=metrics.registry)
+        Counter('second', 'Second counter', registry=metrics.registry)
+
+        self.assertEqual(metrics.generate_metrics()[0], generate_latest(metrics.registry).decode('utf-8'))
+
+        first.inc()
+
+        with patch.object(prometheus_flask_exporter, '_render_family',
+                          wraps=prometheus_flask_exporter._render_family) as render_family:
+            self.assertMetric('first_total', '1.0')
+            self.assertMetric('second_total', '0.0')
+
+            # only the changed family is rendered again, and only once
+            self.assertEqual(render_family.call_count, 1)
+
+        self.assertEqual(metrics.generate_metrics()[0], generate_latest(metrics.registry).decode('utf-8'))
+
+    def test_multiprocess_registry_reused(self):
+        import prometheus_flask_exporter.multiprocess
+        from prometheus_client.mmap_dict import MmapedDict, mmap_key
+
+        with tempfile.TemporaryDirectory() as multiproc_dir, \
+                patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': multiproc_dir}):
+            values = MmapedDict(os.path.join(multiproc_dir, 'counter_1.db'))
+            values.write_value(mmap_key('mp_first', 'mp_first_total', [], [], 'First'), 3.0, 0)
+            values.write_value(mmap_key('mp_second', 'mp_second_total', [], [], 'Second'), 5.0, 0)
+            values.close()
+
+            metrics = self.metrics(export_defaults=False)
+
+            with patch.object(prometheus_flask_exporter.multiprocess, 'IncrementalMultiProcessCollector',
+                              wraps=prometheus_flask_exporter.multiprocess.IncrementalMultiProcessCollector) as collector:
+                for _ in range(3):
+                    response_data, _ = metrics.generate_metrics()
+                    self.assertIn('mp_first_total 3.0', response_data)
+                    self.assertIn('mp_second_total 5.0', response_data)
+
+                    response_data, _ = metrics.generate_metrics(names=['mp_second_total'])
+                    self.assertNotIn('mp_first_total', response_data)
+                    self.assertIn('mp_second_total 5.0', response_data)
+
+                self.assertEqual(collector.call_count, 1)
+
+    def test_metrics_not_compressed_by_default(self):
+        self.metrics()
+
+        response = self.client.get('/metrics', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'# TYPE', response.data)
+
     def test_http_server(self):
         metrics = self.metrics()
 
@@ -487,3 +652,144 @@ class EndpointTest(BaseTestCase):
         # issue #157
         response = self.client.get('/metrics').text
         self.assertNotIn('<lambda>', response)
+
+    def test_excluded_endpoints_with_special_patterns(self):
+        self.metrics(excluded_paths=[
+            '/exc/(one|two)/\\1',
+            '(?i)/upper',
+            '/health'
+        ])
+
+        @self.app.route('/<path:path>')
+        def catch_all(path):
+            return 'OK'
+
+        for path in ('/exc/one/one', '/exc/two/two', '/UPPER', '/health/live', '/exc/one/two', '/included'):
+            self.client.get(path)
+
+        self.assertMetric(
+            'flask_http_request_total', 2.0,
+            ('method', 'GET'), ('status', 200)
+        )
+
+        for path in ('/exc/one/two', '/included'):
+            self.assertMetric(
+                'flask_http_request_duration_seconds_count', 1.0,
+                ('method', 'GET'), ('status', 200), ('path', path)
+            )
+        for path in ('/exc/one/one', '/exc/two/two', '/UPPER', '/health/live'):
+            self.assertAbsent(
+                'flask_http_request_duration_seconds_count',
+                ('method', 'GET'), ('status', 200), ('path', path)
+            )
+
+    def test_excluded_endpoints_with_compiled_patterns(self):
+        import re
+
+        self.metrics(excluded_paths=[re.compile('/health', re.I), re.compile('/ready')])
+
+        @self.app.route('/<path:path>')
+        def catch_all(path):
+            return 'OK'
+
+        for path in ('/HEALTH', '/health', '/ready', '/READY'):
+            self.client.get(path)
+
+        self.assertMetric(
+            'flask_http_request_duration_seconds_count', 1.0,
+            ('method', 'GET'), ('status', 200), ('path', '/READY')
+        )
+        for path in ('/HEALTH', '/health', '/ready'):
+            self.assertAbsent(
+                'flask_http_request_duration_seconds_count',
+                ('method', 'GET'), ('status', 200), ('path', path)
+            )
+
+    def test_excluded_endpoints_and_rules(self):
+        metrics = self.metrics(
+            excluded_endpoints=['health', 'ready'],
+            excluded_rules='/items/<int:item_id>',
+            exclude_user_defaults=True
+        )
+
+        @self.app.route('/health')
+        def health():
+            return 'OK'
+
+        @self.app.route('/ready')
+        def ready():
+            return 'OK'
+
+        @self.app.route('/items/<int:item_id>')
+        def item(item_id):
+            return 'OK'
+
+        @self.app.route('/items')
+        def items():
+            return 'OK'
+
+        metrics.register_default(
+            metrics.counter(
+                name='by_endpoint_counter',
+                description='Request count by endpoint',
+                labels={'endpoint': lambda: request.endpoint}
+            )
+        )
+
+        for path in ('/health', '/ready', '/items/1', '/items/2', '/items'):
+            self.client.get(path)
+
+        self.assertMetric(
+            'flask_http_request_total', 1.0,
+            ('method', 'GET'), ('status', 200)
+        )
+        self.assertMetric(
+            'flask_http_request_duration_seconds_count', 1.0,
+            ('method', 'GET'), ('status', 200), ('path', '/items')
+        )
+        self.assertMetric(
+            'by_endpoint_counter_total', 1.0,
+            ('endpoint', 'items')
+        )
+
+        for endpoint in ('health', 'ready', 'item'):
+            self.assertAbsent(
+                'by_endpoint_counter_total',
+                ('endpoint', endpoint)
+            )
+
+    def test_response_labels_with_wrapping_decorators(self):
+        metrics = self.metrics()
+
+        def passthrough(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                return f(*args, **kwargs)
+            return wrapper
+
+        by_status = metrics.counter(
+            'by_status_counter', 'Request count by status',
+            labels={'status': lambda r: r.status_code}
+        )
+
+        @self.app.route('/wrapped')
+        @passthrough
+        @by_status
+        def wrapped():
+            return 'Created', 201
+
+        @self.app.route('/plain')
+        def plain():
+            return 'Accepted', 202
+
+        for _ in range(3):
+            self.client.get('/wrapped')
+
+        metrics.register_default(by_status)
+
+        for _ in range(2):
+            self.client.get('/wrapped')
+            self.client.get('/plain')
+
+        self.assertMetric('by_status_counter_total', 7.0, ('status', 201))
+        self.assertMetric('by_status_counter_total', 2.0, ('status', 202))
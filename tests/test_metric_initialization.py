@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
+from unittest.mock import patch
 
 from flask import request
+from prometheus_client.metrics import MetricWrapperBase
 
 from unittest_helper import BaseTestCase
 
@@ -71,6 +73,27 @@ class MetricInitializationTest:
             labels = {'path': lambda: request.path}
             self.assertRaises(AssertionError, self._test_metric_initialization, labels)
 
+        def test_static_labels_bound_once(self):
+            metrics = self.metrics(export_defaults=False)
+            metric_decorator = self.get_metric_decorator(metrics)
+
+            for idx, initial_value in enumerate((True, False)):
+                @self.app.route('/test/%d' % idx, endpoint='test_%d' % idx)
+                @metric_decorator('metric_%d' % idx, 'Metric %d' % idx,
+                                  labels={'label_name': 'label_value'},
+                                  initial_value_when_only_static_labels=initial_value)
+                def test():
+                    return 'OK'
+
+            with patch.object(MetricWrapperBase, 'labels', autospec=True,
+                              side_effect=MetricWrapperBase.labels) as labels:
+                for _ in range(3):
+                    self.client.get('/test/0')
+                    self.client.get('/test/1')
+
+                # only the metric without an initial value is bound on its first use
+                self.assertEqual(labels.call_count, 1)
+
 
 
 class HistogramInitializationTest(MetricInitializationTest.MetricInitializationTest):
@@ -1,3 +1,6 @@
+import inspect
+from unittest.mock import patch
+
 from unittest_helper import BaseTestCase
 
 from flask import request
@@ -154,6 +157,27 @@ class MetricsTest(BaseTestCase):
             ('uri', '/test/2'), ('code', 200)
         )
 
+    def test_label_callables_inspected_once(self):
+        metrics = self.metrics()
+
+        @self.app.route('/test')
+        @metrics.counter('cnt_inspected', 'Counter with callable labels', labels={
+            'uri': lambda: request.path,
+            'code': lambda r: r.status_code
+        })
+        def test():
+            return 'OK'
+
+        with patch('inspect.getfullargspec', wraps=inspect.getfullargspec) as argspec:
+            for _ in range(5):
+                self.client.get('/test')
+
+        self.assertEqual(argspec.call_count, 0)
+        self.assertMetric(
+            'cnt_inspected_total', '5.0',
+            ('uri', '/test'), ('code', 200)
+        )
+
     def test_default_format(self):
         self.metrics()
 
@@ -0,0 +1,919 @@
+import errno
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import warnings
+from types import SimpleNamespace
+from unittest.mock import call, patch
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, Summary
+from prometheus_client import generate_latest, values
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from flask import Flask
+
+from prometheus_flask_exporter.multiprocess import AggregatorCollector
+from prometheus_flask_exporter.multiprocess import IncrementalMultiProcessCollector, SharedMemoryCollector
+from prometheus_flask_exporter.multiprocess import GunicornPrometheusMetrics, GunicornInternalPrometheusMetrics
+from prometheus_flask_exporter.multiprocess import UWsgiPrometheusMetrics
+from prometheus_flask_exporter.multiprocess import mark_process_dead, sweep_dead_processes
+
+
+class IncrementalMultiProcessCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pid = '1'
+
+        self.patches = [
+            patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': self.directory.name}),
+            patch.object(values, 'ValueClass', values.MultiProcessValue(lambda: self.pid)),
+            patch('prometheus_flask_exporter.multiprocess._dead_processes', {}),
+        ]
+        for p in self.patches:
+            p.start()
+
+        # the metrics are only written to files, this registry is not exposed
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+        self.directory.cleanup()
+
+    def assertSameOutput(self, collector):
+        expected = CollectorRegistry()
+        MultiProcessCollector(expected)
+
+        self.assertEqual(generate_latest(collector).decode('utf-8'),
+                         generate_latest(expected).decode('utf-8'))
+
+    def create_collector(self, **kwargs):
+        registry = CollectorRegistry()
+        IncrementalMultiProcessCollector(registry, **kwargs)
+        return registry
+
+    def test_same_output(self):
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=self.registry)
+        gauges = [
+            Gauge('mp_gauge_%s' % mode, 'Gauge', ('label',), multiprocess_mode=mode, registry=self.registry)
+            for mode in ('all', 'livesum', 'max', 'mostrecent')
+        ]
+        histogram = Histogram('mp_histogram', 'Histogram', registry=self.registry)
+        summary = Summary('mp_summary', 'Summary', registry=self.registry)
+
+        collector = self.create_collector()
+
+        for pid in ('1', '2'):
+            self.pid = pid
+
+            counter.labels('a').inc(int(pid))
+            for gauge in gauges:
+                gauge.labels('a').set(int(pid) * 10)
+            histogram.observe(int(pid) / 10.0)
+            summary.observe(int(pid))
+
+            self.assertSameOutput(collector)
+
+        # new entries appended to files that were parsed already
+        counter.labels('b').inc(5)
+        gauges[0].labels('b').set(7)
+        histogram.observe(3)
+
+        self.assertSameOutput(collector)
+
+    def test_parallel_reads(self):
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=self.registry)
+        histogram = Histogram('mp_histogram', 'Histogram', registry=self.registry)
+        collector = self.create_collector(read_workers=4)
+
+        for pid in range(1, 20):
+            self.pid = str(pid)
+
+            counter.labels(str(pid % 3)).inc(pid)
+            histogram.observe(pid / 10.0)
+
+        self.assertSameOutput(collector)
+
+        counter.labels('new').inc()
+        self.assertSameOutput(collector)
+
+    def test_grown_files(self):
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=self.registry)
+        collector = self.create_collector()
+
+        counter.labels('first').inc()
+        self.assertSameOutput(collector)
+
+        # enough entries to grow the initial 64 KiB file
+        for idx in range(2000):
+            counter.labels('label-%d' % idx).inc(idx)
+
+        self.assertSameOutput(collector)
+
+    def test_dead_process_files_reused(self):
+        counter = Counter('mp_counter', 'Counter', registry=self.registry)
+        gauge = Gauge('mp_gauge', 'Gauge', multiprocess_mode='livesum', registry=self.registry)
+        collector = self.create_collector()
+
+        counter.inc(3)
+        gauge.set(2)
+
+        self.pid = '2'
+        counter.inc(5)
+        gauge.set(4)
+
+        self.assertSameOutput(collector)
+
+        mark_process_dead('1', self.directory.name)
+
+        # the files of the dead process are read once more
+        self.assertSameOutput(collector)
+
+        with patch.object(IncrementalMultiProcessCollector, '_map_file',
+                          wraps=IncrementalMultiProcessCollector._map_file) as map_file:
+            self.pid = '3'
+            counter.inc(1)
+
+            self.assertSameOutput(collector)
+
+            # the files of the dead process are not read again
+            self.assertEqual(
+                sorted(os.path.basename(args[0]) for args, _ in map_file.call_args_list),
+                ['counter_3.db', 'gauge_livesum_3.db']
+            )
+
+    def test_read_only_directory(self):
+        counter = Counter('mp_counter', 'Counter', registry=self.registry)
+        counter.inc(2)
+
+        collector = self.create_collector()
+
+        def read_only_open(file, mode='r', *args, **kwargs):
+            if any(flag in mode for flag in 'wax+'):
+                raise OSError(errno.EROFS, 'Read-only file system', file)
+            return open(file, mode, *args, **kwargs)
+
+        with patch('prometheus_flask_exporter.multiprocess.open', side_effect=read_only_open, create=True):
+            self.assertIn('mp_counter_total 2.0', generate_latest(collector).decode('utf-8'))
+
+    def test_lock_file_created_by_compaction(self):
+        counter = Counter('mp_counter', 'Counter', registry=self.registry)
+        counter.inc(2)
+
+        collector = self.create_collector()
+        lock_file = os.path.join(self.directory.name, '.compaction.lock')
+
+        # the scrapes don't need a writable directory without compactions
+        self.assertIn('mp_counter_total 2.0', generate_latest(collector).decode('utf-8'))
+        self.assertFalse(os.path.exists(lock_file))
+
+        mark_process_dead(self.pid, self.directory.name, compact=True)
+        self.assertTrue(os.path.exists(lock_file))
+
+        self.pid = '2'
+        counter.inc(3)
+        self.assertIn('mp_counter_total 5.0', generate_latest(collector).decode('utf-8'))
+
+    def test_reused_process_id(self):
+        counter = Counter('mp_counter', 'Counter', registry=self.registry)
+        collector = self.create_collector()
+
+        counter.inc(3)
+        self.pid = '2'
+        counter.inc(5)
+
+        mark_process_dead('1', self.directory.name, compact=True)
+        self.assertSameOutput(collector)
+
+        time.sleep(0.05)
+
+        # a new process with the same process ID
+        self.pid = '1'
+        counter.inc(1)
+        self.assertSameOutput(collector)
+
+        counter.inc(1)
+        self.assertSameOutput(collector)
+        self.assertIn('mp_counter_total 10.0', generate_latest(collector).decode('utf-8'))
+
+    def test_compaction(self):
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=self.registry)
+        histogram = Histogram('mp_histogram', 'Histogram', registry=self.registry)
+        gauge = Gauge('mp_gauge', 'Gauge', multiprocess_mode='livesum', registry=self.registry)
+        collector = self.create_collector()
+
+        for pid in ('1', '2', '3'):
+            self.pid = pid
+
+            counter.labels('a').inc(int(pid))
+            counter.labels(pid).inc()
+            histogram.observe(int(pid) / 10.0)
+            gauge.set(int(pid))
+
+        self.assertSameOutput(collector)
+
+        mark_process_dead('1', self.directory.name, compact=True)
+        self.assertSameOutput(collector)
+
+        GunicornPrometheusMetrics.mark_process_dead_on_child_exit('2', compact=True)
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_counter_total{label="a"} 6.0', output)
+        self.assertIn('mp_counter_total{label="1"} 1.0', output)
+        self.assertIn('mp_histogram_count 3.0', output)
+        self.assertIn('mp_gauge 3.0', output)
+        self.assertSameOutput(collector)
+
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.directory.name) if name.endswith('.db')),
+            ['counter_3.db', 'counter_archive.db', 'gauge_livesum_3.db', 'histogram_3.db', 'histogram_archive.db']
+        )
+
+    def test_sweep_dead_processes(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        self.pid = str(process.pid)
+
+        counter = Counter('mp_counter', 'Counter', registry=self.registry)
+        gauge = Gauge('mp_gauge', 'Gauge', multiprocess_mode='livesum', registry=self.registry)
+
+        for pid in (process.pid, os.getpid()):
+            self.pid = str(pid)
+            counter.inc(2)
+            gauge.set(3)
+
+        collector = self.create_collector(sweep_interval=0)
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_counter_total 4.0', output)
+        self.assertIn('mp_gauge 3.0', output)
+
+        self.assertEqual(
+            sorted(os.path.basename(f) for f in glob.glob(os.path.join(self.directory.name, '*.db'))),
+            ['counter_%d.db' % os.getpid(), 'counter_archive.db', 'gauge_livesum_%d.db' % os.getpid()]
+        )
+        self.assertEqual(sweep_dead_processes(self.directory.name), [])
+
+    def test_failed_sweep(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        self.pid = str(process.pid)
+
+        counter = Counter('mp_counter', 'Counter', registry=self.registry)
+        counter.inc(2)
+
+        collector = self.create_collector(sweep_interval=0)
+
+        with patch('prometheus_flask_exporter.multiprocess.pc_mark_process_dead', side_effect=OSError('failed')), \
+                self.assertLogs('prometheus_flask_exporter.multiprocess', 'ERROR'):
+            # the scrape doesn't fail
+            self.assertIn('mp_counter_total 2.0', generate_latest(collector).decode('utf-8'))
+
+        # a file removed by another process while marking the process dead
+        with patch('prometheus_flask_exporter.multiprocess.pc_mark_process_dead',
+                   side_effect=[FileNotFoundError(), None]) as pc_mark_process_dead:
+            self.assertIn('mp_counter_total 2.0', generate_latest(collector).decode('utf-8'))
+
+        self.assertEqual(pc_mark_process_dead.call_count, 2)
+        self.assertEqual(
+            [os.path.basename(f) for f in glob.glob(os.path.join(self.directory.name, '*.db'))],
+            ['counter_archive.db']
+        )
+
+
+    def test_collector_options_when_ready(self):
+        with patch('prometheus_flask_exporter.multiprocess.pc_start_http_server') as start_http_server:
+            GunicornPrometheusMetrics.start_http_server_when_ready(9200, read_workers=2, sweep_interval=30)
+
+        registry = start_http_server.call_args[1]['registry']
+        collector, = [c for c in registry._collector_to_names if isinstance(c, IncrementalMultiProcessCollector)]
+        self.assertEqual(collector._read_workers, 2)
+        self.assertEqual(collector._sweep_interval, 30)
+
+
+class OlderClientTest(unittest.TestCase):
+    def test_falls_back_to_the_upstream_collector(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}), \
+                patch('prometheus_flask_exporter.multiprocess._TIMESTAMPED_FILES', False):
+            metrics = GunicornPrometheusMetrics(Flask(__name__))
+
+            collectors = list(metrics.registry._collector_to_names)
+            self.assertTrue(any(type(collector) is MultiProcessCollector for collector in collectors))
+            self.assertFalse(any(isinstance(collector, IncrementalMultiProcessCollector)
+                                 for collector in collectors))
+
+            with self.assertRaises(RuntimeError):
+                IncrementalMultiProcessCollector(None, directory)
+            with self.assertRaises(RuntimeError):
+                GunicornPrometheusMetrics.use_batched_writes()
+
+
+class WorkerSlotsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.patches = [
+            patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': self.directory.name}),
+            patch.object(values, 'ValueClass', values.ValueClass),
+            patch('prometheus_flask_exporter.multiprocess._gunicorn_forked_slot', None),
+            patch('prometheus_flask_exporter.multiprocess._gunicorn_slots', {}),
+            patch('prometheus_flask_exporter.multiprocess._dead_processes', {}),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+        self.directory.cleanup()
+
+    def db_files(self):
+        return sorted(os.path.basename(f) for f in glob.glob(os.path.join(self.directory.name, '*.db')))
+
+    def test_gunicorn_slot_allocation(self):
+        server = SimpleNamespace(WORKERS={})
+
+        def fork(pid):
+            worker = SimpleNamespace(pid=None)
+            GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, worker)
+            worker.pid = pid
+            server.WORKERS[pid] = worker
+
+        fork(101)
+        fork(102)
+        fork(103)
+
+        # the worker in slot 1 is replaced
+        del server.WORKERS[102]
+
+        with patch('prometheus_flask_exporter.multiprocess.mark_process_dead') as mark_process_dead:
+            GunicornPrometheusMetrics.mark_process_dead_on_child_exit(102)
+            mark_process_dead.assert_called_once_with('slot1', compact=False)
+
+        with patch('os.getppid', return_value=os.getpid()):
+            fork(104)
+
+            from prometheus_flask_exporter.multiprocess import _gunicorn_process_identifier
+            self.assertEqual(_gunicorn_process_identifier(), 'slot1')
+
+        # the arbiter itself (or anything else) is identified by its process ID
+        self.assertEqual(_gunicorn_process_identifier(), str(os.getpid()))
+
+    def test_gunicorn_replacement_worker_keeps_counting(self):
+        server = SimpleNamespace(WORKERS={})
+        collector = CollectorRegistry()
+        IncrementalMultiProcessCollector(collector)
+
+        with patch('os.getppid', return_value=os.getpid()):
+            for _ in range(2):
+                # a new worker process in the same slot, with its own metrics
+                GunicornPrometheusMetrics.use_worker_slots()
+                GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, SimpleNamespace(pid=None))
+
+                counter = Counter('mp_counter', 'Counter', registry=CollectorRegistry())
+                counter.inc(2)
+
+        self.assertIn('mp_counter_total 4.0', generate_latest(collector).decode('utf-8'))
+        self.assertEqual(self.db_files(), ['counter_slot0.db'])
+
+    def test_uwsgi_worker_ids(self):
+        worker_id = {'value': 2}
+        uwsgi = SimpleNamespace(worker_id=lambda: worker_id['value'])
+
+        with patch.dict(sys.modules, {'uwsgi': uwsgi}):
+            UWsgiPrometheusMetrics.use_worker_ids()
+
+            Counter('mp_counter', 'Counter', registry=CollectorRegistry()).inc()
+            self.assertEqual(self.db_files(), ['counter_worker2.db'])
+
+            from prometheus_flask_exporter.multiprocess import _uwsgi_process_identifier
+
+            worker_id['value'] = 0  # the master process
+            self.assertEqual(_uwsgi_process_identifier(), str(os.getpid()))
+
+    def test_uwsgi_respawned_worker_gauges(self):
+        uwsgi = SimpleNamespace(worker_id=lambda: 1)
+
+        # left behind by a worker that crashed
+        for mode in ('livesum', 'all', 'max'):
+            file_values = MmapedDict(os.path.join(self.directory.name, 'gauge_%s_worker1.db' % mode))
+            file_values.write_value(mmap_key('mp_gauge_%s' % mode, 'mp_gauge_%s' % mode, [], [], 'Gauge'), 5.0, 0.0)
+            file_values.close()
+
+        with patch.dict(sys.modules, {'uwsgi': uwsgi}):
+            UWsgiPrometheusMetrics.use_worker_ids()
+
+            gauges = [
+                Gauge('mp_gauge_%s' % mode, 'Gauge', multiprocess_mode=mode, registry=CollectorRegistry())
+                for mode in ('livesum', 'all', 'max')
+            ]
+            for gauge in gauges:
+                gauge.inc()
+
+        registry = CollectorRegistry()
+        IncrementalMultiProcessCollector(registry)
+        output = generate_latest(registry).decode('utf-8')
+
+        self.assertIn('mp_gauge_livesum 1.0', output)
+        self.assertIn('mp_gauge_all{pid="worker1"} 1.0', output)
+        # the gauges across processes are kept
+        self.assertIn('mp_gauge_max 6.0', output)
+
+    def test_gunicorn_exited_worker_slots_dropped(self):
+        from prometheus_flask_exporter.multiprocess import _gunicorn_slots
+
+        server = SimpleNamespace(WORKERS={})
+        worker = SimpleNamespace(pid=None)
+        GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, worker)
+        worker.pid = 101
+
+        with patch('prometheus_flask_exporter.multiprocess.mark_process_dead') as mark_process_dead:
+            GunicornPrometheusMetrics.mark_process_dead_on_child_exit(101)
+            self.assertEqual(_gunicorn_slots, {})
+
+            # the process ID is reused by something else later
+            GunicornPrometheusMetrics.mark_process_dead_on_child_exit(101)
+
+        self.assertEqual(mark_process_dead.call_args_list,
+                         [call('slot0', compact=False), call(101, compact=False)])
+
+
+class SharedMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.slot = 0
+
+        self.patches = [
+            patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': self.directory.name}),
+            patch.object(values, 'ValueClass', values.ValueClass),
+            patch('prometheus_flask_exporter.multiprocess._shared_memory', None),
+            patch('prometheus_flask_exporter.multiprocess._gunicorn_forked_slot', None),
+            patch('prometheus_flask_exporter.multiprocess._gunicorn_slots', {}),
+            patch('prometheus_flask_exporter.multiprocess._dead_processes', {}),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+        self.directory.cleanup()
+
+    def create_metrics(self):
+        registry = CollectorRegistry()
+
+        return [
+            Counter('mp_counter', 'Counter', ('label',), registry=registry),
+            Gauge('mp_gauge_all', 'Gauge', multiprocess_mode='all', registry=registry),
+            Gauge('mp_gauge_livesum', 'Gauge', multiprocess_mode='livesum', registry=registry),
+            Gauge('mp_gauge_liveall', 'Gauge', multiprocess_mode='liveall', registry=registry),
+            Histogram('mp_histogram', 'Histogram', registry=registry),
+        ]
+
+    def update_metrics(self, metrics, value):
+        counter, gauge_all, gauge_livesum, gauge_liveall, histogram = metrics
+
+        counter.labels('a').inc(value)
+        counter.labels(str(self.slot)).inc()
+        gauge_all.set(value)
+        gauge_livesum.inc(value)
+        gauge_liveall.set(value * 2)
+        histogram.observe(value / 10.0)
+
+    def test_same_output_as_worker_slot_files(self):
+        from prometheus_flask_exporter.multiprocess import _use_shared_memory
+
+        file_value = values.MultiProcessValue(process_identifier=lambda: 'slot%d' % self.slot)
+        values.ValueClass = file_value
+        file_metrics = self.create_metrics()
+        expected = CollectorRegistry()
+        MultiProcessCollector(expected)
+
+        _use_shared_memory(2, 4096, lambda: self.slot)
+        shared_value = values.ValueClass
+        shared_metrics = self.create_metrics()
+        collector = CollectorRegistry()
+        SharedMemoryCollector(collector)
+
+        def update_metrics(value):
+            # the children of labelled metrics are created with the current value class
+            for value_class, metrics in ((file_value, file_metrics), (shared_value, shared_metrics)):
+                values.ValueClass = value_class
+                self.update_metrics(metrics, value)
+
+        def assertSameOutput(without_gauges=False):
+            def lines(registry):
+                # the order of the families depends on the order of the files
+                return sorted(line for line in generate_latest(registry).decode('utf-8').splitlines()
+                              if not (without_gauges and 'mp_gauge' in line))
+
+            self.assertEqual(lines(collector), lines(expected))
+
+        for slot in (0, 1):
+            self.slot = slot
+            update_metrics(slot + 3)
+            assertSameOutput()
+
+        # the worker in slot 0 exits
+        from prometheus_flask_exporter.multiprocess import _shared_memory
+        _shared_memory.release(0)
+        mark_process_dead('slot0', self.directory.name)
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_gauge_livesum 4.0', output)
+        self.assertIn('mp_gauge_all{pid="slot0"} 3.0', output)
+        self.assertNotIn('mp_gauge_liveall{pid="slot0"}', output)
+        assertSameOutput()
+
+        # a new worker in slot 0 continues with its counters
+        self.slot = 0
+        update_metrics(5)
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_counter_total{label="a"} 12.0', output)
+        self.assertIn('mp_gauge_livesum 9.0', output)
+        assertSameOutput()
+
+    def test_gunicorn_workers(self):
+        server = SimpleNamespace(WORKERS={})
+
+        GunicornPrometheusMetrics.use_shared_memory(slots=2, slot_size=4096)
+
+        with patch.dict(os.environ, clear=True):
+            # the multiprocess directory is not needed
+            app = Flask(__name__)
+            GunicornInternalPrometheusMetrics(app)
+
+        @app.route('/test')
+        def test():
+            return 'OK'
+
+        for pid in (101, 102):
+            worker = SimpleNamespace(pid=pid)
+            GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, worker)
+            server.WORKERS[pid] = worker
+
+        with self.assertRaises(ValueError):
+            GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, SimpleNamespace(pid=None))
+
+        with patch('os.getppid', return_value=os.getpid()):
+            # in the worker of slot 1
+            client = app.test_client()
+            client.get('/test')
+            client.get('/test')
+
+            response = client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('flask_http_request_total{method="GET",status="200"} 2.0',
+                      response.data.decode('utf-8'))
+        self.assertEqual(glob.glob(os.path.join(self.directory.name, '*.db')), [])
+
+        with patch('prometheus_flask_exporter.multiprocess.mark_process_dead') as mark_process_dead:
+            del server.WORKERS[101]
+            GunicornPrometheusMetrics.mark_process_dead_on_child_exit(101)
+            mark_process_dead.assert_not_called()
+
+        # slot 0 is free again
+        GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, SimpleNamespace(pid=None))
+
+        from prometheus_flask_exporter.multiprocess import _gunicorn_forked_slot
+        self.assertEqual(_gunicorn_forked_slot, (os.getpid(), 0))
+
+    def test_full_slot(self):
+        from prometheus_flask_exporter.multiprocess import _use_shared_memory
+
+        _use_shared_memory(1, 256, lambda: 0)
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=CollectorRegistry())
+
+        counter.labels('first').inc()
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+
+            for idx in range(10):
+                counter.labels('label-%d' % idx).inc()
+
+        # warned once, the new series are not collected, but they still count
+        self.assertEqual([warning.category for warning in caught], [RuntimeWarning])
+        self.assertEqual(counter.labels('label-9')._value.get(), 1.0)
+
+        registry = CollectorRegistry()
+        SharedMemoryCollector(registry)
+        output = generate_latest(registry).decode('utf-8')
+        self.assertIn('mp_counter_total{label="first"} 1.0', output)
+        self.assertNotIn('label-9', output)
+
+
+class AggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pid = 1
+
+        self.patches = [
+            patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': self.directory.name}),
+            patch.object(values, 'ValueClass', values.ValueClass),
+            patch('prometheus_flask_exporter.multiprocess._aggregator', None),
+            patch('prometheus_flask_exporter.multiprocess._dead_processes', {}),
+        ]
+        for p in self.patches:
+            p.start()
+
+        self.socket_directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.socket_directory.name, 'aggregator.sock')
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+        self.directory.cleanup()
+        self.socket_directory.cleanup()
+
+    def test_same_output_as_files(self):
+        from prometheus_flask_exporter.multiprocess import _MetricsAggregator, _aggregated_value
+
+        aggregator = _MetricsAggregator(self.socket_path)
+        aggregator.start()
+
+        file_value = values.MultiProcessValue(process_identifier=lambda: str(self.pid))
+        aggregated_value = _aggregated_value(self.socket_path, 60, process_identifier=lambda: self.pid)
+
+        metrics = {}
+        for value_class in (file_value, aggregated_value):
+            values.ValueClass = value_class
+            registry = CollectorRegistry()
+
+            metrics[value_class] = (
+                Counter('mp_counter', 'Counter', ('label',), registry=registry),
+                Gauge('mp_gauge_all', 'Gauge', multiprocess_mode='all', registry=registry),
+                Gauge('mp_gauge_livesum', 'Gauge', multiprocess_mode='livesum', registry=registry),
+                Gauge('mp_gauge_max', 'Gauge', multiprocess_mode='max', registry=registry),
+                Histogram('mp_histogram', 'Histogram', registry=registry),
+            )
+
+        expected = CollectorRegistry()
+        MultiProcessCollector(expected)
+        collector = CollectorRegistry()
+        AggregatorCollector(collector, aggregator)
+
+        def update_metrics(value):
+            for value_class, (counter, gauge_all, gauge_livesum, gauge_max, histogram) in metrics.items():
+                # the children of labelled metrics are created with the current value class
+                values.ValueClass = value_class
+
+                counter.labels('a').inc(value)
+                counter.labels(str(self.pid)).inc()
+                gauge_all.set(value)
+                gauge_livesum.inc(value)
+                gauge_max.set(value * 2)
+                histogram.observe(value / 10.0)
+
+            aggregated_value.flush()
+
+        def assertSameOutput(without_gauges=False):
+            def lines(registry):
+                # the order of the families depends on the order of the files
+                return sorted(line for line in generate_latest(registry).decode('utf-8').splitlines()
+                              if not (without_gauges and 'mp_gauge' in line))
+
+            self.assertEqual(lines(collector), lines(expected))
+
+        for pid in (1, 2):
+            self.pid = pid
+            update_metrics(pid + 3)
+            assertSameOutput()
+
+        # the process 1 exits, its gauges are dropped by the aggregator
+        mark_process_dead(1, self.directory.name, compact=True)
+        aggregator.mark_process_dead(1)
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_gauge_livesum 5.0', output)
+        self.assertNotIn('pid="1"', output)
+        assertSameOutput(without_gauges=True)
+
+        # a new process, then one reusing the process ID of the one that exited
+        for pid in (3, 1):
+            self.pid = pid
+            update_metrics(5)
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_counter_total{label="a"} 19.0', output)
+        self.assertIn('mp_counter_total{label="1"} 2.0', output)
+        self.assertIn('mp_gauge_livesum 15.0', output)
+
+    def test_dead_processes_archived(self):
+        from prometheus_flask_exporter.multiprocess import _MetricsAggregator, _aggregated_value
+
+        aggregator = _MetricsAggregator(self.socket_path)
+        aggregator.start()
+
+        values.ValueClass = _aggregated_value(self.socket_path, 60, process_identifier=lambda: self.pid)
+        registry = CollectorRegistry()
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=registry)
+        gauge = Gauge('mp_gauge', 'Gauge', multiprocess_mode='all', registry=registry)
+
+        collector = CollectorRegistry()
+        AggregatorCollector(collector, aggregator)
+
+        for pid in range(2, 102):
+            self.pid = pid
+            counter.labels('a').inc()
+            gauge.set(pid)
+            values.ValueClass.flush()
+            aggregator.mark_process_dead(pid)
+
+        # a late datagram of an exited process is not counted again
+        counter.labels('a').inc()
+        values.ValueClass.flush()
+
+        self.assertEqual(list(aggregator._processes), ['archive'])
+        self.assertEqual(generate_latest(collector).decode('utf-8').count('mp_counter_total{label="a"} 100.0'), 1)
+        self.assertNotIn('mp_gauge{', generate_latest(collector).decode('utf-8'))
+
+    def test_oversized_series(self):
+        from prometheus_flask_exporter.multiprocess import _MetricsAggregator, _aggregated_value
+
+        aggregator = _MetricsAggregator(self.socket_path)
+        aggregator.start()
+
+        values.ValueClass = _aggregated_value(self.socket_path, 60, process_identifier=lambda: self.pid)
+        registry = CollectorRegistry()
+        counter = Counter('mp_counter', 'Counter', ('label',), registry=registry)
+
+        counter.labels('x' * 20000).inc()
+        counter.labels('a').inc()
+
+        with self.assertLogs('prometheus_flask_exporter.multiprocess', 'WARNING') as logs:
+            values.ValueClass.flush()
+
+        self.assertEqual(len(logs.records), 1)
+
+        counter.labels('x' * 20000).inc()
+        counter.labels('a').inc()
+        values.ValueClass.flush()
+
+        collector = CollectorRegistry()
+        AggregatorCollector(collector, aggregator)
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('mp_counter_total{label="a"} 2.0', output)
+        self.assertNotIn('xxx', output)
+
+    def test_gunicorn_metrics_served_from_the_aggregator(self):
+        with patch.dict(os.environ, clear=True):
+            # the multiprocess directory is not needed
+            GunicornPrometheusMetrics.use_aggregator(socket_path=self.socket_path, flush_interval=60)
+
+            app = Flask(__name__)
+            metrics = GunicornPrometheusMetrics(app)
+
+        @app.route('/test')
+        def test():
+            return 'OK'
+
+        client = app.test_client()
+        # not sent from the process that created the aggregator
+        client.get('/test')
+        values.ValueClass.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            # a worker
+            status = 1
+            try:
+                client.get('/test')
+                client.get('/test')
+                values.ValueClass.flush()
+                status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+        with self.assertRaises(RuntimeError):
+            # the aggregator was not started in this process
+            generate_latest(metrics.registry)
+
+        from prometheus_flask_exporter.multiprocess import _aggregator
+        _aggregator.start()
+
+        self.assertIn('flask_http_request_total{method="GET",status="200"} 2.0',
+                      generate_latest(metrics.registry).decode('utf-8'))
+        self.assertEqual(glob.glob(os.path.join(self.directory.name, '*.db')), [])
+
+        with patch.object(_aggregator, 'mark_process_dead') as mark_process_dead:
+            GunicornPrometheusMetrics.mark_process_dead_on_child_exit(101)
+            mark_process_dead.assert_called_once_with(101)
+
+
+class BatchedWritesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.patches = [
+            patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': self.directory.name}),
+            patch.object(values, 'ValueClass', values.ValueClass),
+            patch('prometheus_flask_exporter.multiprocess._batched_writes', False),
+            patch('prometheus_flask_exporter.multiprocess._process_identifier', os.getpid),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+        self.directory.cleanup()
+
+    def test_batched_writes(self):
+        GunicornInternalPrometheusMetrics.use_batched_writes()
+
+        app = Flask(__name__)
+        metrics = GunicornInternalPrometheusMetrics(app)
+
+        collector = CollectorRegistry()
+        MultiProcessCollector(collector)
+        outputs = []
+
+        @app.route('/test')
+        @metrics.counter('cnt_test', 'Counter')
+        @metrics.gauge('gauge_test', 'Gauge', multiprocess_mode='livesum')
+        def test():
+            outputs.append(generate_latest(collector).decode('utf-8'))
+            return 'OK'
+
+        client = app.test_client()
+
+        with patch.object(MmapedDict, 'write_value', autospec=True,
+                          side_effect=MmapedDict.write_value) as write_value:
+            # the batch is written when the server closes the response
+            client.get('/test').close()
+
+            # the counter, the request total, and the sum and one bucket of the duration
+            # are written at once, the gauge is written when it's changed
+            self.assertEqual(write_value.call_count, 4 + 2)
+
+        self.assertIn('gauge_test 1.0', outputs[0])
+        self.assertIn('cnt_test_total 0.0', outputs[0])
+
+        client.get('/test').close()
+
+        output = generate_latest(collector).decode('utf-8')
+        self.assertIn('cnt_test_total 2.0', output)
+        self.assertIn('gauge_test 0.0', output)
+        self.assertIn('flask_http_request_total{method="GET",status="200"} 2.0', output)
+        self.assertIn('flask_http_request_duration_seconds_count{method="GET",path="/test",status="200"} 2.0', output)
+
+    def test_changes_after_a_batch(self):
+        GunicornInternalPrometheusMetrics.use_batched_writes()
+
+        registry = CollectorRegistry()
+        counter = Counter('mp_counter', 'Counter', registry=registry)
+        gauge = Gauge('mp_gauge', 'Gauge', multiprocess_mode='livesum', registry=registry)
+
+        values.ValueClass.start_batch()
+        counter.inc(2)
+        values.ValueClass.apply_batch()
+
+        # on the same thread, outside of a batch
+        gauge.set(3)
+        counter.inc()
+        self.assertEqual(gauge._value.get(), 3.0)
+        self.assertEqual(counter._value.get(), 3.0)
+
+    def test_worker_slots_kept(self):
+        server = SimpleNamespace(WORKERS={})
+
+        with patch('prometheus_flask_exporter.multiprocess._gunicorn_forked_slot', None), \
+                patch('prometheus_flask_exporter.multiprocess._gunicorn_slots', {}), \
+                patch('os.getppid', return_value=os.getpid()):
+            GunicornPrometheusMetrics.use_worker_slots()
+            GunicornPrometheusMetrics.use_batched_writes()
+            GunicornPrometheusMetrics.allocate_worker_slot_on_pre_fork(server, SimpleNamespace(pid=None))
+
+            counter = Counter('mp_counter', 'Counter', registry=CollectorRegistry())
+
+            values.ValueClass.start_batch()
+            counter.inc(2)
+            counter.inc(3)
+            self.assertEqual(counter._value.get(), 5.0)
+            values.ValueClass.apply_batch()
+
+        self.assertEqual(
+            [os.path.basename(f) for f in glob.glob(os.path.join(self.directory.name, '*.db'))],
+            ['counter_slot0.db']
+        )
+
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        self.assertIn('mp_counter_total 5.0', generate_latest(registry).decode('utf-8'))